@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Benchmark trackpoint download from a simulated device into the cache
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from optparse import OptionParser
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'pykmaze'))
+
+from capture import ReplayTransport
+from db import KeymazeCache
+from keymaze import KeymazePort
+from simulator import KeymazeSimulator
+
+
+def run(name, options, log, capture=None, replay=None, **link):
+    tracks = [KeymazeSimulator.make_track(track, options.points) \
+                  for track in range(options.tracks)]
+    sim = KeymazeSimulator(tracks, seed=0, **link)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        transport = replay and ReplayTransport(replay)
+        port = KeymazePort(log, sim.portname, verbose=False,
+                           transport=transport, capture=capture)
+        cache = KeymazeCache(log, os.path.join(tmpdir, 'bench.sqlite'), port)
+        start = time.time()
+        retries = 0
+        info = cache.get_information()
+        device = info['device']
+        for tp in cache.get_trackpoint_catalog(device):
+            while True:
+                try:
+                    cache.load_trackpoints(device, tp['track'])
+                    break
+                except AssertionError, e:
+                    # degraded link: resume the download
+                    retries += 1
+                    if retries > options.retries:
+                        raise
+        elapsed = time.time()-start
+        port.close()
+        count = options.points*options.tracks
+        print '%-10s %8d points in %7.3fs: %7.3fs per 10k points, ' \
+              '%d requests, %d retries' % \
+              (name, count, elapsed, 10000*elapsed/count, sim.requests,
+               retries)
+    finally:
+        sim.close()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    optparser = OptionParser(usage='Usage: %prog [options]')
+    optparser.add_option('-n', '--points', dest='points', type='int',
+                         default=10000, help='Points per track')
+    optparser.add_option('-t', '--tracks', dest='tracks', type='int',
+                         default=1, help='Count of tracks')
+    optparser.add_option('-b', '--baudrate', dest='baudrate', type='int',
+                         default=KeymazePort.KM_BAUDRATE,
+                         help='Simulated link speed, for the throttled runs')
+    optparser.add_option('-l', '--latency', dest='latency', type='float',
+                         default=0.005, help='Simulated response latency (s)')
+    optparser.add_option('-N', '--noise', dest='noise', type='float',
+                         default=1e-6, help='Byte corruption probability')
+    optparser.add_option('-D', '--drop', dest='drop', type='float',
+                         default=1e-6, help='Byte loss probability')
+    optparser.add_option('-r', '--retries', dest='retries', type='int',
+                         default=20, help='Max download retries')
+    (options, args) = optparser.parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.CRITICAL)
+    log = logging.getLogger('bench')
+    run('raw', options, log)
+    run('latency', options, log, latency=options.latency)
+    trace = tempfile.NamedTemporaryFile(suffix='.trace')
+    run('throttled', options, log, capture=trace.name,
+        baudrate=options.baudrate, latency=options.latency)
+    # decode and cache the captured traffic without the link bottleneck
+    run('replay', options, log, replay=trace.name)
+    run('degraded', options, log, baudrate=options.baudrate,
+        latency=options.latency, noise=options.noise, drop=options.drop)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Benchmark trackpoint ingestion into the SQLite cache
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from optparse import OptionParser
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'pykmaze'))
+
+from db import KeymazeCache, sqlparams
+
+
+class FakeDevice(object):
+    """Provide synthetic trackpoints, chunked as the device does"""
+
+    CHUNK = 120
+
+    def __init__(self, count):
+        self.count = count
+
+    def read_trackpoints(self, track):
+        return ({'count': self.count}, self._chunks())
+
+    def _chunks(self):
+        for base in xrange(0, self.count, self.CHUNK):
+            yield ('%031d' % base,
+                   [(45000000+i, 5000000+i, 100+i%50, i%300, 120+i%40, 10) \
+                       for i in xrange(base, min(base+self.CHUNK,
+                                                 self.count))])
+
+
+def legacy_load(cache, device, track):
+    """Former implementation: one SQL statement built and run per point"""
+    tpoints = cache.device.get_trackpoints(track)
+    c = cache.db.cursor()
+    point = 0
+    for tp in tpoints['points']:
+        point += 1
+        values = [device, track, point]
+        values.extend(tp)
+        c.execute('INSERT INTO tp_points VALUES (%s)' % sqlparams(values),
+                  values)
+    cache.db.commit()
+
+
+def legacy_points(fake, track):
+    (tp, chunks) = fake.read_trackpoints(track)
+    tp['points'] = [p for (header, points) in chunks for p in points]
+    return tp
+
+
+def run(name, loader, count, tracks, log):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fake = FakeDevice(count)
+        fake.get_trackpoints = lambda track: legacy_points(fake, track)
+        cache = KeymazeCache(log, os.path.join(tmpdir, 'bench.sqlite'), fake)
+        start = time.time()
+        for track in range(tracks):
+            loader(cache, 1, track)
+        elapsed = time.time()-start
+        print '%-8s %8d points in %6.3fs: %9.0f points/s' % \
+            (name, count*tracks, elapsed, count*tracks/elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    optparser = OptionParser(usage='Usage: %prog [options]')
+    optparser.add_option('-n', '--points', dest='points', type='int',
+                         default=20000, help='Points per track')
+    optparser.add_option('-t', '--tracks', dest='tracks', type='int',
+                         default=5, help='Count of tracks')
+    (options, args) = optparser.parse_args(sys.argv[1:])
+    log = logging.getLogger('bench')
+    run('legacy', legacy_load, options.points, options.tracks, log)
+    run('bulk', KeymazeCache._load_trackpoints, options.points,
+        options.tracks, log)
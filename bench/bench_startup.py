@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+#-----------------------------------------------------------------------------
+# Benchmark the startup time of an offline catalog query
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from optparse import OptionParser
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+PYKMAZE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, 'pykmaze')
+sys.path.insert(0, PYKMAZE)
+
+from db import KeymazeCache
+from keymaze import KeymazePort
+from simulator import KeymazeSimulator
+
+# modules an offline catalog query should never load
+FORBIDDEN = ('serial', 'pkg_resources', 'numpy', 'multiprocessing', 'json',
+             'keymaze', 'kml', 'gpx', 'simplify')
+
+# run the command line tool, and report the modules it has loaded
+LOADER = '''
+import runpy, sys
+sys.path.insert(0, %(path)r)
+sys.argv = %(argv)r
+runpy.run_path(%(script)r, run_name='__main__')
+out = open(%(modules)r, 'wt')
+out.write('\\n'.join(sorted([m for m in sys.modules if sys.modules[m]])))
+out.close()
+'''
+
+
+def build_cache(dbpath, tracks, points):
+    log = logging.getLogger('bench')
+    sim = KeymazeSimulator([KeymazeSimulator.make_track(track, points) \
+                                for track in range(tracks)])
+    try:
+        port = KeymazePort(log, sim.portname, verbose=False)
+        cache = KeymazeCache(log, dbpath, port)
+        device = cache.get_information()['device']
+        for tp in cache.get_trackpoint_catalog(device):
+            cache.load_trackpoints(device, tp['track'])
+        port.close()
+    finally:
+        sim.close()
+
+
+def importtime(argv):
+    """Report the slowest imports, if the interpreter supports -X importtime"""
+    cmd = [sys.executable, '-X', 'importtime',
+           os.path.join(PYKMAZE, 'pykmaze.py')] + argv
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    (out, err) = proc.communicate()
+    if proc.returncode:
+        return None
+    imports = []
+    for line in err.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line.split(':', 1)[1].split('|')
+        try:
+            imports.append((int(fields[1]), fields[2].strip()))
+        except ValueError:
+            # column titles
+            continue
+    return sorted(imports, reverse=True)
+
+
+if __name__ == '__main__':
+    optparser = OptionParser(usage='Usage: %prog [options]')
+    optparser.add_option('-n', '--runs', dest='runs', type='int',
+                         default=10, help='Count of measured runs')
+    optparser.add_option('-t', '--tracks', dest='tracks', type='int',
+                         default=20, help='Count of cached tracks')
+    optparser.add_option('-b', '--budget', dest='budget', type='float',
+                         default=0.3,
+                         help='Maximum median startup time, in seconds')
+    (options, args) = optparser.parse_args(sys.argv[1:])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dbpath = os.path.join(tmpdir, 'bench.sqlite')
+        build_cache(dbpath, options.tracks, 100)
+        argv = ['pykmaze', '--offline', '-c', '-s', dbpath]
+        modules = os.path.join(tmpdir, 'modules')
+        loader = LOADER % { 'path': PYKMAZE,
+                            'argv': argv,
+                            'script': os.path.join(PYKMAZE, 'pykmaze.py'),
+                            'modules': modules }
+        devnull = open(os.devnull, 'wb')
+        times = []
+        for run in range(options.runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', loader],
+                                  stdout=devnull, stderr=devnull)
+            times.append(time.time()-start)
+        times.sort()
+        median = times[len(times)//2]
+        loaded = open(modules, 'rt').read().split()
+        forbidden = [m for m in loaded if m.split('.')[0] in FORBIDDEN]
+        print 'offline catalog: median %.3fs, min %.3fs, %d modules' % \
+            (median, times[0], len(loaded))
+        imports = importtime(argv[1:])
+        if imports is not None:
+            for (cumulative, name) in imports[:10]:
+                print '  %8dus  %s' % (cumulative, name)
+        if forbidden:
+            print 'Unexpected modules: %s' % ', '.join(forbidden)
+        if median > options.budget:
+            print 'Over the %.3fs budget' % options.budget
+        if forbidden or median > options.budget:
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tmpdir)
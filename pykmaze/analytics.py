@@ -0,0 +1,87 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from array import array
+import numpy
+
+EARTH_RADIUS = 6371.0*1000 # m
+
+# Version of the computations, cached results of former versions are
+# discarded
+VERSION = 1
+
+# Count of points of the moving average applied to altitudes before the
+# elevation gain and loss are summed up
+ALT_WINDOW = 5
+
+# Upper bounds of the heart rate zones, in percent of the maximum heart rate
+HEART_ZONES = (60, 70, 80, 90)
+
+# Length of the splits, in meters
+SPLIT = 1000
+
+
+def analyze(track, maxheart):
+    """Compute the statistics of a Track, with vectorized operations.
+
+       Return a dictionary with the distance and the elevation gain and
+       loss, in meters, the duration of each full SPLIT, and the time spent
+       in each heart rate zone, in tenths of second.
+    """
+    lat = numpy.radians(track.numpy('lat')/track.DEGREE)
+    lon = numpy.radians(track.numpy('lon')/track.DEGREE)
+    dist = haversine(lat, lon)
+    (climb, descent) = elevation(track.numpy('alt'))
+    deltas = track.numpy('delta').astype(numpy.int64)
+    return { 'distance' : float(dist.sum()),
+             'climb' : climb,
+             'descent' : descent,
+             'splits' : splits(dist, deltas),
+             'zones' : heart_zones(track.numpy('heart'), deltas, maxheart) }
+
+def haversine(lat, lon):
+    """Distance series between consecutive positions, given in radians"""
+    if len(lat) < 2:
+        return numpy.zeros(0)
+    dlat = numpy.diff(lat)
+    dlon = numpy.diff(lon)
+    a = numpy.sin(dlat/2)**2 + \
+        numpy.cos(lat[:-1])*numpy.cos(lat[1:])*numpy.sin(dlon/2)**2
+    return 2*EARTH_RADIUS*numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1-a))
+
+def elevation(alt):
+    """Elevation gain and loss of a smoothed altitude series"""
+    if len(alt) < 2:
+        return (0.0, 0.0)
+    window = min(ALT_WINDOW, len(alt))
+    smooth = numpy.convolve(alt.astype(float), numpy.ones(window)/window,
+                            mode='valid')
+    steps = numpy.diff(smooth)
+    return (float(steps[steps > 0].sum()), float(-steps[steps < 0].sum()))
+
+def splits(dist, deltas):
+    """Duration of each full split, in tenths of second"""
+    distance = numpy.concatenate(([0.0], numpy.cumsum(dist)))
+    times = numpy.cumsum(deltas)
+    count = int(distance[-1]//SPLIT)
+    durations = array('i')
+    if not count:
+        return durations
+    # time at each split boundary, interpolated between trackpoints
+    marks = numpy.interp(numpy.arange(count+1)*SPLIT, distance, times)
+    durations.extend([int(round(d)) for d in numpy.diff(marks)])
+    return durations
+
+def heart_zones(heart, deltas, maxheart):
+    """Time spent within each heart rate zone, in tenths of second. Points
+       without a heart rate are not accounted for"""
+    bounds = numpy.array(HEART_ZONES)*maxheart/100.0
+    zones = numpy.searchsorted(bounds, heart, side='right')
+    valid = heart > 0
+    time = numpy.bincount(zones[valid], weights=deltas[valid],
+                          minlength=len(HEART_ZONES)+1)
+    return array('i', [int(t) for t in time])
@@ -0,0 +1,138 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import struct
+import time
+
+# A trace file starts with a magic string, a format version and the link
+# baudrate, followed with one record per transfer: the time elapsed since
+# the start of the capture, the direction, the byte count, then the bytes
+TRACE_MAGIC = 'KMTRACE'
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct('>%dsBI' % len(TRACE_MAGIC))
+TRACE_RECORD = struct.Struct('>dBI')
+
+TX = 0
+RX = 1
+
+
+class CaptureTransport(object):
+    """Transport wrapper that records all the traffic to a trace file.
+
+       Bytes discarded while draining the line are not recorded.
+    """
+
+    def __init__(self, transport, path, baudrate):
+        self._transport = transport
+        self.byte_time = transport.byte_time
+        self._out = open(path, 'wb')
+        self._out.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION,
+                                          baudrate))
+        self._start = time.time()
+
+    def write(self, data):
+        self._record(TX, data)
+        self._transport.write(data)
+
+    def recv(self, size, timeout):
+        data = self._transport.recv(size, timeout)
+        self._record(RX, data)
+        return data
+
+    def drain(self, wait=True):
+        self._transport.drain(wait)
+
+    def close(self):
+        self._out.close()
+        self._transport.close()
+
+    def _record(self, direction, data):
+        if data:
+            self._out.write(TRACE_RECORD.pack(time.time()-self._start,
+                                              direction, len(data)))
+            self._out.write(data)
+
+
+class ReplayTransport(object):
+    """Transport that plays a trace file back.
+
+       Requests are checked against the recorded ones. Responses are
+       delivered at once, or, if realtime is set, with the delay they were
+       received with after their request.
+    """
+
+    def __init__(self, path, realtime=False):
+        self.realtime = realtime
+        self._records = []
+        self._pos = 0
+        self._pending = ''
+        self._sent = None
+        with open(path, 'rb') as trace:
+            header = trace.read(TRACE_HEADER.size)
+            if len(header) < TRACE_HEADER.size:
+                raise AssertionError('Invalid trace file "%s"' % path)
+            (magic, version, baudrate) = TRACE_HEADER.unpack(header)
+            if magic != TRACE_MAGIC or version != TRACE_VERSION:
+                raise AssertionError('Invalid trace file "%s"' % path)
+            self.baudrate = baudrate
+            self.byte_time = 10.0/baudrate
+            data = trace.read()
+        offset = 0
+        while offset+TRACE_RECORD.size <= len(data):
+            (stamp, direction, size) = TRACE_RECORD.unpack_from(data, offset)
+            offset += TRACE_RECORD.size
+            self._records.append((stamp, direction,
+                                  data[offset:offset+size]))
+            offset += size
+        # time of the last request, in the trace and in the replay
+        self._stamp = 0.0
+        self._now = time.time()
+
+    def write(self, data):
+        # skip the responses that have not been consumed
+        while self._pos < len(self._records) and \
+                self._records[self._pos][1] != TX:
+            self._pos += 1
+        if self._pos >= len(self._records):
+            raise AssertionError('End of trace')
+        (stamp, direction, request) = self._records[self._pos]
+        if request != data:
+            raise AssertionError('Replay diverges from trace at record %d' % \
+                                    self._pos)
+        self._pos += 1
+        self._pending = ''
+        self._stamp = stamp
+        self._now = time.time()
+
+    def recv(self, size, timeout):
+        if not self._pending:
+            if self._pos >= len(self._records) or \
+                    self._records[self._pos][1] != RX:
+                # the device did not answer
+                if self.realtime:
+                    time.sleep(timeout)
+                return ''
+            (stamp, direction, self._pending) = self._records[self._pos]
+            self._pos += 1
+            if self.realtime:
+                delay = self._now+(stamp-self._stamp)-time.time()
+                if delay > timeout:
+                    time.sleep(timeout)
+                    # keep the response for the next attempt
+                    self._pos -= 1
+                    self._pending = ''
+                    return ''
+                if delay > 0:
+                    time.sleep(delay)
+        (data, self._pending) = (self._pending[:size], self._pending[size:])
+        return data
+
+    def drain(self, wait=True):
+        pass
+
+    def close(self):
+        pass
@@ -5,8 +5,16 @@
 # @license MIT License, see LICENSE file
 #-----------------------------------------------------------------------------
 
+from array import array
+from contextlib import contextmanager
+from pack import pack_column, unpack_column
+from track import Track
+import datetime
+import math
 import os
 import sqlite3
+import threading
+import time
 
 
 def sqlparams(values):
@@ -32,18 +40,65 @@ class KeymazeCache(object):
     
     TRACKPOINT = ('device','track','point','lat','long','alt','speed',
                   'heart','delta')
+
+    TRACKSUMMARY = ('device','track','count','altmin','altmax','delta')
+
+    # Trackpoint storage layouts: one row per point, or one row per track
+    # with a compact binary column per value, optionally zlib-compressed
+    LAYOUTS = ('rows', 'packed', 'zpacked')
+
+    # Version of the database layout, upgraded by the _upgrade_v<n> methods
+    SCHEMA_VERSION = 11
+
+    # Most device responses committed at once, and longest time received
+    # responses are left uncommitted, in seconds
+    BATCH_CHUNKS = 32
+    COMMIT_PERIOD = 1.0
+
+    # Count of trackpoints covered by each box of the spatial index
+    SEGMENT = 64
+
+    EARTH_RADIUS = 6371.0*1000 # m
+
+    # Periods of the activity rollups, and their totals
+    PERIODS = ('week', 'month', 'year')
+    ROLLUP = ('count', 'distance', 'time', 'kcal', 'climb')
+
+    # Douglas-Peucker tolerances of the levels of detail of the tracks, in
+    # meters, coarsest first
+    LOD = (250.0, 50.0, 10.0)
     
-    def __init__(self, log, dbpath, device=None):
+    def __init__(self, log, dbpath, device=None, lock=None):
         self.log = log
         self.device = device
+        # catalog retrieved from the device, once per session
+        self._device_catalog = None
+        # several caches may share the same database from different threads,
+        # in which case they share the lock that serializes their writes
+        self._lock = lock or threading.RLock()
         create = False
         if not os.path.isfile(dbpath):
             create = True
             if not os.path.isdir(os.path.dirname(dbpath)):
                 os.makedirs(os.path.dirname(dbpath))
         self.db = sqlite3.connect(dbpath)
+        self._configure()
         if create:
             self._initialize()
+        self._upgrade()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            with self.db:
+                yield
+
+    def _configure(self):
+        c = self.db.cursor()
+        # write-ahead logging only syncs on checkpoints, which is safe enough
+        # for a cache that can always be reloaded from the device
+        c.execute('PRAGMA journal_mode=WAL')
+        c.execute('PRAGMA synchronous=NORMAL')
             
     def _initialize(self):
         self.log.debug("Initialize")
@@ -55,17 +110,178 @@ class KeymazeCache(object):
         sql = ','.join('%s INTEGER' % it for it in KeymazeCache.TRACKPOINT)
         c.execute('CREATE TABLE tp_points (%s)' % sql)
         self.db.commit()
+
+    def _upgrade(self):
+        c = self.db.cursor()
+        c.execute('PRAGMA user_version')
+        version = c.fetchone()[0]
+        if version > self.SCHEMA_VERSION:
+            raise AssertionError('Unsupported cache version %d' % version)
+        while version < self.SCHEMA_VERSION:
+            version += 1
+            self.log.info('Upgrading cache to version %d' % version)
+            with self._transaction():
+                getattr(self, '_upgrade_v%d' % version)(c)
+                c.execute('PRAGMA user_version=%d' % version)
+
+    def _upgrade_v1(self, c):
+        """Index the trackpoints, and summarize each track once for all"""
+        c.execute('CREATE INDEX IF NOT EXISTS tp_points_track ON tp_points '
+                  '(device, track, point)')
+        sql = ','.join('%s INTEGER' % it for it in KeymazeCache.TRACKSUMMARY)
+        c.execute('CREATE TABLE IF NOT EXISTS tp_summary '
+                  '(%s, PRIMARY KEY (device, track))' % sql)
+        c.execute('INSERT INTO tp_summary SELECT device,track,COUNT(*),'
+                  'MIN(alt),MAX(alt),SUM(delta) FROM tp_points '
+                  'GROUP BY device,track')
+
+    def _upgrade_v2(self, c):
+        """Add the packed trackpoint storage"""
+        sql = ','.join('%s BLOB' % it for it in KeymazeCache.TRACKPOINT[3:])
+        c.execute('CREATE TABLE IF NOT EXISTS tp_packed (device INTEGER, '
+                  'track INTEGER, count INTEGER, zlib INTEGER, %s, '
+                  'PRIMARY KEY (device, track))' % sql)
+        c.execute('CREATE TABLE IF NOT EXISTS cache_info '
+                  '(key TEXT PRIMARY KEY, value TEXT)')
+        c.execute('INSERT OR IGNORE INTO cache_info VALUES (?,?)',
+                  ('layout', self.LAYOUTS[0]))
+
+    def _upgrade_v3(self, c):
+        """Track the device responses of trackpoint downloads"""
+        c.execute('CREATE TABLE IF NOT EXISTS tp_chunks (device INTEGER, '
+                  'track INTEGER, chunk INTEGER, first INTEGER, '
+                  'count INTEGER, header BLOB, '
+                  'PRIMARY KEY (device, track, chunk))')
+
+    def _upgrade_v4(self, c):
+        """Fingerprint the last retrieved catalog of each device"""
+        c.execute('CREATE TABLE IF NOT EXISTS dev_catalog '
+                  '(device INTEGER PRIMARY KEY, count INTEGER, '
+                  'newest INTEGER)')
+
+    def _upgrade_v5(self, c):
+        """Index the bounding boxes of the track segments"""
+        c.execute('CREATE TABLE IF NOT EXISTS tp_segments '
+                  '(id INTEGER PRIMARY KEY, device INTEGER, track INTEGER, '
+                  'first INTEGER, count INTEGER)')
+        c.execute('CREATE INDEX IF NOT EXISTS tp_segments_track ON '
+                  'tp_segments (device, track)')
+        try:
+            c.execute('CREATE VIRTUAL TABLE IF NOT EXISTS tp_bbox USING '
+                      'rtree(id, minlat, maxlat, minlon, maxlon)')
+        except sqlite3.OperationalError:
+            # SQLite has been built without the R*Tree module: the boxes
+            # are scanned, which is still far cheaper than the trackpoints
+            c.execute('CREATE TABLE IF NOT EXISTS tp_bbox '
+                      '(id INTEGER PRIMARY KEY, minlat REAL, maxlat REAL, '
+                      'minlon REAL, maxlon REAL)')
+
+    def _upgrade_v6(self, c):
+        """Store the statistics computed from the trackpoints"""
+        c.execute('CREATE TABLE IF NOT EXISTS tp_analytics (device INTEGER, '
+                  'track INTEGER, version INTEGER, maxheart INTEGER, '
+                  'distance REAL, climb REAL, descent REAL, splits BLOB, '
+                  'zones BLOB, PRIMARY KEY (device, track))')
+
+    def _upgrade_v7(self, c):
+        """Maintain the activity totals per week, month and year"""
+        c.execute('CREATE TABLE IF NOT EXISTS rollups (device INTEGER, '
+                  'period TEXT, key TEXT, %s, '
+                  'PRIMARY KEY (device, period, key))' % \
+                  ','.join(['%s INTEGER' % it for it in self.ROLLUP]))
+        self._build_rollups(c)
+
+    def _upgrade_v8(self, c):
+        """Store the levels of detail of the tracks"""
+        c.execute('CREATE TABLE IF NOT EXISTS tp_lod (device INTEGER, '
+                  'track INTEGER, level INTEGER, tolerance REAL, '
+                  'count INTEGER, points BLOB, '
+                  'PRIMARY KEY (device, track, level))')
+
+    def _upgrade_v9(self, c):
+        """Keep track of the rendered export files (see ExportCache)"""
+        c.execute('CREATE TABLE IF NOT EXISTS exports (key TEXT PRIMARY KEY, '
+                  'device INTEGER, track INTEGER, size INTEGER, used REAL)')
+
+    def _upgrade_v10(self, c):
+        """Store the split count of the track statistics, which the
+           distance rounding cannot be relied upon to tell"""
+        c.execute('DELETE FROM tp_analytics')
+        c.execute('ALTER TABLE tp_analytics ADD COLUMN splitcount INTEGER')
+
+    def _upgrade_v11(self, c):
+        """Account for the ascent of all the catalog entries in the rollups,
+           rather than for the elevation gain of the loaded tracks"""
+        c.execute('DROP TABLE IF EXISTS tp_climb')
+        self._build_rollups(c)
+
+    def _build_rollups(self, c):
+        """Compute the rollups from the cached catalog entries"""
+        c.execute('DELETE FROM rollups')
+        c.execute('SELECT device,start,time,distance,kcal,cmlplus '
+                  'FROM tp_catalog')
+        for (device, start, duration, distance, kcal, climb) in c.fetchall():
+            self._add_rollup(device, start, count=1, distance=distance,
+                             time=duration, kcal=kcal, climb=climb)
+
+    def get_layout(self):
+        """Report the storage layout of newly loaded tracks"""
+        c = self.db.cursor()
+        c.execute('SELECT value FROM cache_info WHERE key=?', ('layout',))
+        return c.fetchone()[0]
+
+    def convert(self, layout):
+        """Convert all cached trackpoints to the specified storage layout,
+           which is also used for any track loaded afterwards"""
+        if layout not in self.LAYOUTS:
+            raise AssertionError('Unsupported layout "%s"' % layout)
+        c = self.db.cursor()
+        c.execute('SELECT device,track FROM tp_summary')
+        for (device, track) in c.fetchall():
+            self.log.info('Converting track %u' % track)
+            columns = self.get_track_columns(device, track)
+            with self._transaction():
+                self._delete_trackpoints(device, track)
+                self._store_columns(device, track, columns, layout)
+        with self._transaction():
+            self.db.execute('UPDATE cache_info SET value=? WHERE key=?',
+                            (layout, 'layout'))
+        # give the released pages back to the file system
+        self.db.execute('VACUUM')
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
         
     def get_information(self, sn=None):
         c = self.db.cursor()
         if self.device:
-            info = {}
-            self.log.debug('Querying device info')
-            info = self.device.get_information()
-            if not info:
-                raise AssertionErrror('Unable to retrieve device information')
+            # the catalog cannot tell apart devices that hold the same
+            # tracks, so the device is always asked for its serial number
+            sn = self._query_information()
+        info = {}
+        if sn:
+            c.execute('SELECT * FROM dev_info WHERE serialnumber=?', (sn,))
+        else:
+            # default to the first discovered device
+            c.execute('SELECT * FROM dev_info ORDER BY device LIMIT 1')
+        row = c.fetchone()
+        if not row:
+            raise AssertionError('No device discovered yet')
+        for (k,v) in zip([it.split(' ')[0] for it in KeymazeCache.DEVINFO],
+                         row):
+            info[k] = v
+        return info
+
+    def _query_information(self):
+        """Retrieve the device information, cache it if the device is a new
+           one, and return the device serial number"""
+        c = self.db.cursor()
+        self.log.debug('Querying device info')
+        info = self.device.get_information()
+        if not info:
+            raise AssertionError('Unable to retrieve device information')
+        sn = info['serialnumber']
+        with self._transaction():
             c.execute('SELECT device FROM dev_info WHERE serialnumber=?',
-                      (info['serialnumber'], ))
+                      (sn, ))
             if not c.fetchone():
                 keys = []
                 values = []
@@ -74,68 +290,295 @@ class KeymazeCache(object):
                     values.append(v)
                 c.execute('INSERT INTO dev_info (%s) VALUES (%s)' % 
                             (','.join(keys), sqlparams(values)), values)
-            self.db.commit()
-        info = {}
-        c.execute('SELECT * FROM dev_info WHERE device=?', (1,))
-        row = c.fetchone()
-        if not row:
-            raise AssertionError('No device discovered yet')
-        for (k,v) in zip([it.split(' ')[0] for it in KeymazeCache.DEVINFO],
-                         row):
-            info[k] = v
-        return info
-        
+        return sn
+
+    def _get_device_catalog(self):
+        if self._device_catalog is None:
+            self.log.debug('Refresh catalog')
+            self._device_catalog = self.device.get_trackpoint_catalog()
+        return self._device_catalog
+
+    @staticmethod
+    def _catalog_fingerprint(tpcat):
+        """Summarize a device catalog as its entry count and newest entry"""
+        return (len(tpcat), max([tp['start'] for tp in tpcat] or [None]))
+
     def get_trackpoint_catalog(self, device):
         c = self.db.cursor()
-        c.execute('SELECT start FROM tp_catalog WHERE device=?', 
-                  (device,))
-        tracks = [row[0] for row in c]
         if self.device:
-            self.log.debug('Refresh catalog')
-            tpcat = self.device.get_trackpoint_catalog()
-            for tp in tpcat:
-                if tp['start'] in tracks:
-                    continue
-                self.log.info('%u is not in cache' % tp['start'])
-                values = []
-                tp['device'] = device
-                for k in self.TRACKINFO:
-                    values.append(tp[k])
-                c.execute('INSERT INTO tp_catalog VALUES (%s)' % \
-                            sqlparams(values), values)    
-                self.db.commit()
-        c.execute('SELECT %s FROM tp_catalog WHERE device=?' % \
-                  ','.join(self.TRACKINFO), (device,))
+            tpcat = self._get_device_catalog()
+            fingerprint = self._catalog_fingerprint(tpcat)
+            c.execute('SELECT count,newest FROM dev_catalog WHERE device=?',
+                      (device,))
+            if c.fetchone() != fingerprint:
+                self._update_catalog(device, tpcat, fingerprint)
+        c.execute('SELECT %s,s.altmin,s.altmax,s.delta FROM tp_catalog c '
+                  'LEFT JOIN tp_summary s '
+                  'ON s.device=c.device AND s.track=c.track '
+                  'WHERE c.device=?' % \
+                  ','.join(['c.%s' % k for k in self.TRACKINFO]), (device,))
         tpcat = []
         for row in c.fetchall():
             tp = {}
             for (k,v) in zip(KeymazeCache.TRACKINFO, row):
                 tp[k] = v
-            cextra = self.db.cursor()
-            track = tp['track']
-            cextra.execute('SELECT MIN(alt),MAX(alt),SUM(delta) FROM tp_points'
-                           ' WHERE device=? AND track=?', (device, track))
-            rextra = cextra.fetchone()
-            (tp['altmin'], tp['altmax']) = rextra[0:2]
-            tp['duration'] = rextra[2] and rextra[2]//10
+            (tp['altmin'], tp['altmax'], delta) = row[-3:]
+            tp['duration'] = delta and delta//10
             tpcat.append(tp)
         return tpcat
 
+    def _update_catalog(self, device, tpcat, fingerprint):
+        """Add the device catalog entries that are not cached yet"""
+        c = self.db.cursor()
+        c.execute('SELECT start FROM tp_catalog WHERE device=?', (device,))
+        known = set([row[0] for row in c])
+        rows = []
+        for tp in tpcat:
+            if tp['start'] in known:
+                continue
+            self.log.info('%u is not in cache' % tp['start'])
+            known.add(tp['start'])
+            tp['device'] = device
+            rows.append([tp[k] for k in self.TRACKINFO])
+        with self._transaction():
+            if rows:
+                c.executemany('INSERT INTO tp_catalog VALUES (%s)' % \
+                                  sqlparams(self.TRACKINFO), rows)
+            for row in rows:
+                tp = dict(zip(self.TRACKINFO, row))
+                self._add_rollup(device, tp['start'], count=1,
+                                 distance=tp['distance'], time=tp['time'],
+                                 kcal=tp['kcal'], climb=tp['cmlplus'])
+            c.execute('INSERT OR REPLACE INTO dev_catalog VALUES (?,?,?)',
+                      (device,)+fingerprint)
+
     def get_trackpoints(self, device, track):
+        return Track(self.get_track_columns(device, track))
+
+    def load_trackpoints(self, device, track):
+        """Ensure the trackpoints of an activity are cached"""
         c = self.db.cursor()
-        c.execute('SELECT track FROM tp_points WHERE device=? AND track=? '
-                  'LIMIT 1', (device, track))
+        c.execute('SELECT track FROM tp_summary WHERE device=? AND track=?',
+                  (device, track))
         row = c.fetchone()
         if not row:
             self.log.debug('Trackpoint not in cache')
             if not self.device:
                 raise AssertionError('Device is not available')
             self._load_trackpoints(device, track)
+
+    def get_track_columns(self, device, track):
+        """Obtain the trackpoints of an activity, as one array per value,
+           in TRACKPOINT order"""
+        self.load_trackpoints(device, track)
+        return self._read_columns(device, track)
+
+    def _read_columns(self, device, track):
+        c = self.db.cursor()
+        c.execute('SELECT count,zlib,%s FROM tp_packed '
+                  'WHERE device=? AND track=?' % \
+                  ','.join(self.TRACKPOINT[3:]), (device, track))
+        row = c.fetchone()
+        if row:
+            (count, compress) = row[:2]
+            return tuple([unpack_column(data, count, compress) \
+                              for data in row[2:]])
+        return self._read_rows(device, track)
+
+    def _read_rows(self, device, track):
+        c = self.db.cursor()
         c.execute('SELECT %s FROM tp_points WHERE device=? AND track=? '
                   'ORDER BY point' % ','.join(self.TRACKPOINT[3:]), 
                   (device, track))
-        return c.fetchall()
+        columns = tuple([array('i') for it in self.TRACKPOINT[3:]])
+        rows = c.fetchall()
+        if rows:
+            for (column, values) in zip(columns, zip(*rows)):
+                column.extend(values)
+        return columns
         
+    def get_analytics(self, device, track, maxheart):
+        """Obtain the statistics of a track (see analytics.analyze), which
+           are only computed once for all"""
+        import analytics
+        c = self.db.cursor()
+        c.execute('SELECT distance,climb,descent,splits,zones,splitcount '
+                  'FROM tp_analytics WHERE device=? AND track=? '
+                  'AND version=? AND maxheart=?',
+                  (device, track, analytics.VERSION, maxheart))
+        row = c.fetchone()
+        if row:
+            (distance, climb, descent, splits, zones, splitcount) = row
+            return { 'distance' : distance,
+                     'climb' : climb,
+                     'descent' : descent,
+                     'splits' : unpack_column(str(splits), splitcount),
+                     'zones' : unpack_column(str(zones),
+                                             len(analytics.HEART_ZONES)+1) }
+        stats = analytics.analyze(self.get_trackpoints(device, track),
+                                  maxheart)
+        with self._transaction():
+            c.execute('INSERT OR REPLACE INTO tp_analytics VALUES '
+                      '(?,?,?,?,?,?,?,?,?,?)',
+                      (device, track, analytics.VERSION, maxheart,
+                       stats['distance'], stats['climb'], stats['descent'],
+                       buffer(pack_column(stats['splits'])),
+                       buffer(pack_column(stats['zones'])),
+                       len(stats['splits'])))
+        return stats
+
+    def get_lod(self, device, track):
+        """Obtain the levels of detail of a track, as (tolerance, indices)
+           pairs in LOD order, where indices are the sorted indices of the
+           trackpoints kept at this level. Levels are only computed once"""
+        levels = self._read_lod(device, track)
+        if levels is None:
+            levels = self._build_lod(device, track)
+        return levels
+
+    def build_lod(self, device):
+        """Compute the levels of detail of the cached tracks that do not
+           have them yet, return the count of tracks they were computed for"""
+        c = self.db.cursor()
+        c.execute('SELECT s.track,l.tolerance FROM tp_summary s '
+                  'LEFT JOIN tp_lod l '
+                  'ON l.device=s.device AND l.track=s.track '
+                  'WHERE s.device=? ORDER BY s.track,l.level', (device,))
+        tolerances = {}
+        for (track, tolerance) in c.fetchall():
+            tolerances.setdefault(track, []).append(tolerance)
+        built = 0
+        for track in sorted(tolerances):
+            if tuple(tolerances[track]) != self.LOD:
+                self._build_lod(device, track)
+                built += 1
+        return built
+
+    def _read_lod(self, device, track):
+        c = self.db.cursor()
+        c.execute('SELECT tolerance,count,points FROM tp_lod '
+                  'WHERE device=? AND track=? ORDER BY level', (device, track))
+        rows = c.fetchall()
+        if tuple([row[0] for row in rows]) != self.LOD:
+            return None
+        return [(tolerance, unpack_column(str(points), count)) \
+                    for (tolerance, count, points) in rows]
+
+    def _build_lod(self, device, track):
+        from simplify import simplify
+        points = self.get_trackpoints(device, track)
+        (lat, lon) = (points.degrees('lat'), points.degrees('lon'))
+        levels = []
+        for tolerance in self.LOD:
+            indices = array('i', simplify(lat, lon, None, 'dp', tolerance))
+            levels.append((tolerance, indices))
+        with self._transaction():
+            self.db.execute('DELETE FROM tp_lod WHERE device=? AND track=?',
+                            (device, track))
+            self.db.executemany('INSERT INTO tp_lod VALUES (?,?,?,?,?,?)',
+                                [(device, track, level, tolerance,
+                                  len(indices), buffer(pack_column(indices))) \
+                                     for (level, (tolerance, indices)) \
+                                         in enumerate(levels)])
+        return levels
+
+    def use_export(self, key):
+        """Tell whether a rendered export is known, and record its use"""
+        c = self.db.cursor()
+        with self._transaction():
+            c.execute('UPDATE exports SET used=? WHERE key=?',
+                      (time.time(), key))
+        return c.rowcount > 0
+
+    def add_export(self, key, device, track, size):
+        with self._transaction():
+            self.db.execute('INSERT OR REPLACE INTO exports VALUES '
+                            '(?,?,?,?,?)',
+                            (key, device, track, size, time.time()))
+
+    def remove_exports(self, keys):
+        with self._transaction():
+            self.db.executemany('DELETE FROM exports WHERE key=?',
+                                [(key,) for key in keys])
+
+    def get_exports(self):
+        """Obtain the (key, size) of the rendered exports, least recently
+           used first"""
+        c = self.db.cursor()
+        c.execute('SELECT key,size FROM exports ORDER BY used')
+        return c.fetchall()
+
+    def get_rollups(self, device, period):
+        """Obtain the activity totals of a device for each week, month or
+           year, in period order"""
+        if period not in self.PERIODS:
+            raise AssertionError('Unsupported period "%s"' % period)
+        c = self.db.cursor()
+        c.execute('SELECT key,%s FROM rollups WHERE device=? AND period=? '
+                  'ORDER BY key' % ','.join(self.ROLLUP), (device, period))
+        return [dict(zip(('key',)+self.ROLLUP, row)) for row in c.fetchall()]
+
+    @staticmethod
+    def _rollup_keys(start):
+        """Keys of the periods a track starting at start belongs to"""
+        day = datetime.date.fromtimestamp(start)
+        (year, week, weekday) = day.isocalendar()
+        return (('week', '%04d-W%02d' % (year, week)),
+                ('month', '%04d-%02d' % (day.year, day.month)),
+                ('year', '%04d' % day.year))
+
+    def _add_rollup(self, device, start, **totals):
+        """Add to the totals of the periods a track belongs to"""
+        values = [totals.get(it) or 0 for it in self.ROLLUP]
+        for (period, key) in self._rollup_keys(start):
+            self.db.execute('INSERT OR IGNORE INTO rollups VALUES (%s)' % \
+                                sqlparams(('device', 'period', 'key') + \
+                                              self.ROLLUP),
+                            [device, period, key] + [0]*len(self.ROLLUP))
+            self.db.execute('UPDATE rollups SET %s '
+                            'WHERE device=? AND period=? AND key=?' % \
+                                ','.join(['%s=%s+?' % (it, it) \
+                                             for it in self.ROLLUP]),
+                            values + [device, period, key])
+
+    def find_tracks(self, minlat, minlon, maxlat, maxlon, device=None):
+        """Find the cached tracks that cross a bounding box, in degrees.
+
+           Return a list of (device, track, ranges) tuples, where ranges is
+           a list of (first, stop) ranges of the indices of the trackpoints
+           around the box, in track order, with the granularity of the
+           index segments.
+        """
+        self._index_tracks()
+        c = self.db.cursor()
+        sql = 'SELECT s.device,s.track,s.first,s.count FROM tp_bbox b ' \
+              'JOIN tp_segments s ON s.id=b.id ' \
+              'WHERE b.maxlat>=? AND b.minlat<=? AND b.maxlon>=? ' \
+              'AND b.minlon<=?'
+        values = [minlat, maxlat, minlon, maxlon]
+        if device is not None:
+            sql += ' AND s.device=?'
+            values.append(device)
+        c.execute(sql + ' ORDER BY s.device,s.track,s.first', values)
+        tracks = []
+        for (device, track, first, count) in c:
+            if not tracks or tracks[-1][:2] != (device, track):
+                tracks.append((device, track, []))
+            ranges = tracks[-1][2]
+            if ranges and first <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], first+count))
+            else:
+                ranges.append((first, first+count))
+        return tracks
+
+    def find_tracks_near(self, lat, lon, radius, device=None):
+        """Find the cached tracks that pass within about radius meters of
+           a position, in degrees (see find_tracks)"""
+        dlat = math.degrees(radius/self.EARTH_RADIUS)
+        dlon = dlat/max(math.cos(math.radians(lat)), 1e-6)
+        return self.find_tracks(lat-dlat, lon-dlon, lat+dlat, lon+dlon,
+                                device)
+
     def get_device(self, sn):
         c = self.db.cursor()
         c.execute('SELECT device FROM dev_info WHERE serialnumber=?', (sn,))
@@ -145,13 +588,193 @@ class KeymazeCache(object):
         return row[0]
 
     def _load_trackpoints(self, device, track):
-        tpoints = self.device.get_trackpoints(track)
+        # Device responses are committed by batches, at least every
+        # COMMIT_PERIOD seconds, so that an interrupted download can be
+        # resumed. The device protocol cannot skip over trackpoints, so the
+        # chunks that are already cached are received again, but only
+        # checked against the cache.
+        c = self.db.cursor()
+        c.execute('SELECT first,count,header FROM tp_chunks '
+                  'WHERE device=? AND track=? ORDER BY chunk', (device, track))
+        committed = [(first, count, str(header)) \
+                         for (first, count, header) in c.fetchall()]
+        c.execute('SELECT COUNT(*) FROM tp_points WHERE device=? AND track=?',
+                  (device, track))
+        if c.fetchone()[0] != sum([it[1] for it in committed]):
+            # cached chunks do not match cached trackpoints
+            with self._transaction():
+                self._truncate_trackpoints(device, track, 0, 0)
+            committed = []
+        if committed:
+            self.log.info('Resuming download of track %u after %d points' % \
+                          (track, sum([it[1] for it in committed])))
+        (header, chunks) = self.device.read_trackpoints(track)
+        deadline = time.time()+self.COMMIT_PERIOD
+        first = 0
+        received = 0
+        batch = []
+        # points of all the chunks, for the spatial index
+        positions = []
+        try:
+            for (chunk_header, points) in chunks:
+                chunk = received
+                received += 1
+                positions.append(points)
+                if chunk < len(committed):
+                    if committed[chunk] == (first, len(points), chunk_header):
+                        first += len(points)
+                        continue
+                    self.log.warning('Track %u differs from the cached one, '
+                                     'discarding cached chunks' % track)
+                    with self._transaction():
+                        self._truncate_trackpoints(device, track, chunk, first)
+                    committed = []
+                batch.append((chunk, first, chunk_header, points))
+                first += len(points)
+                if len(batch) < self.BATCH_CHUNKS and time.time() < deadline:
+                    continue
+                (pending, batch) = (batch, [])
+                self._store_chunks(device, track, pending)
+                deadline = time.time()+self.COMMIT_PERIOD
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+            # the chunks received before a failure are kept as well, so that
+            # the download resumes after them
+            if batch:
+                self._store_chunks(device, track, batch)
+        if first != header['count']:
+            # a chunk has been missed or received twice, and the cached
+            # chunks cannot tell which one
+            with self._transaction():
+                self._truncate_trackpoints(device, track, 0, 0)
+            raise AssertionError('Track %u: received %d / %d points' % \
+                                 (track, first, header['count']))
+        layout = self.get_layout()
+        with self._transaction():
+            self._truncate_trackpoints(device, track, received, first)
+            if layout == 'rows':
+                self._update_summary(device, track)
+            else:
+                columns = self._read_rows(device, track)
+                self.db.execute('DELETE FROM tp_points '
+                                'WHERE device=? AND track=?', (device, track))
+                self._store_columns(device, track, columns, layout)
+            # the index is built from the received points, rather than
+            # from the stored ones
+            (lat, lon) = (array('i'), array('i'))
+            for points in positions:
+                lat.extend([tp[0] for tp in points])
+                lon.extend([tp[1] for tp in points])
+            self._index_track(device, track, (lat, lon))
+            for table in ('tp_analytics', 'tp_lod', 'exports'):
+                self.db.execute('DELETE FROM %s WHERE device=? AND track=?' % \
+                                    table, (device, track))
+
+    def _store_chunks(self, device, track, batch):
+        """Commit a batch of (chunk, first, header, points) received chunks"""
+        with self._transaction():
+            for (chunk, first, chunk_header, points) in batch:
+                self.db.executemany('INSERT INTO tp_points VALUES (%s)' % \
+                                        sqlparams(self.TRACKPOINT),
+                                    self._iter_rows(device, track, points,
+                                                    first))
+            self.db.executemany('INSERT OR REPLACE INTO tp_chunks VALUES '
+                                '(?,?,?,?,?,?)', 
+                                [(device, track, chunk, first, len(points),
+                                  buffer(chunk_header)) for \
+                                     (chunk, first, chunk_header, points) in \
+                                     batch])
+
+    def _truncate_trackpoints(self, device, track, chunk, first):
+        """Discard the cached trackpoints from the specified chunk"""
+        self.db.execute('DELETE FROM tp_points WHERE device=? AND track=? '
+                        'AND point>?', (device, track, first))
+        self.db.execute('DELETE FROM tp_chunks WHERE device=? AND track=? '
+                        'AND chunk>=?', (device, track, chunk))
+
+    def _store_columns(self, device, track, columns, layout):
+        (lat, lon, alt, speed, heart, delta) = columns
+        if layout == 'rows':
+            self.db.executemany('INSERT INTO tp_points VALUES (%s)' % \
+                                    sqlparams(self.TRACKPOINT),
+                                self._iter_rows(device, track,
+                                                zip(*columns)))
+            self._update_summary(device, track)
+            return
+        compress = layout == 'zpacked'
+        values = [device, track, len(lat), int(compress)]
+        values.extend([buffer(pack_column(column, compress)) \
+                           for column in columns])
+        self.db.execute('INSERT OR REPLACE INTO tp_packed VALUES (%s)' % \
+                            sqlparams(values), values)
+        if len(lat):
+            self.db.execute('INSERT OR REPLACE INTO tp_summary VALUES '
+                            '(%s)' % sqlparams(self.TRACKSUMMARY),
+                            (device, track, len(lat), min(alt), max(alt),
+                             sum(delta)))
+
+    def _index_tracks(self):
+        """Index the cached tracks that are not indexed yet, which are the
+           ones loaded before the spatial index existed (schema version 4).
+           Tracks are otherwise indexed as they are loaded"""
         c = self.db.cursor()
-        point = 0
-        for tp in tpoints['points']:
+        c.execute('SELECT device,track FROM tp_summary s WHERE NOT EXISTS '
+                  '(SELECT 1 FROM tp_segments WHERE device=s.device '
+                  'AND track=s.track)')
+        for (device, track) in c.fetchall():
+            columns = self._read_columns(device, track)
+            with self._transaction():
+                self._index_track(device, track, columns)
+
+    def _index_track(self, device, track, columns):
+        """Replace the spatial index entries of a track, from its latitude
+           and longitude columns"""
+        c = self.db.cursor()
+        self._unindex_track(device, track)
+        c.execute('SELECT MAX(id) FROM tp_segments')
+        segment = (c.fetchone()[0] or 0)+1
+        (lat, lon) = columns[:2]
+        scale = Track.DEGREE
+        segments = []
+        boxes = []
+        for first in xrange(0, max(len(lat)-1, 1), self.SEGMENT):
+            # consecutive segments share a point, so that the line that
+            # joins them is covered as well
+            stop = min(first+self.SEGMENT+1, len(lat))
+            if stop <= first:
+                break
+            (seglat, seglon) = (lat[first:stop], lon[first:stop])
+            segments.append((segment, device, track, first, stop-first))
+            boxes.append((segment, min(seglat)/scale, max(seglat)/scale,
+                          min(seglon)/scale, max(seglon)/scale))
+            segment += 1
+        c.executemany('INSERT INTO tp_segments (id,device,track,first,count) '
+                      'VALUES (?,?,?,?,?)', segments)
+        c.executemany('INSERT INTO tp_bbox VALUES (?,?,?,?,?)', boxes)
+
+    def _unindex_track(self, device, track):
+        self.db.execute('DELETE FROM tp_bbox WHERE id IN (SELECT id FROM '
+                        'tp_segments WHERE device=? AND track=?)',
+                        (device, track))
+        self.db.execute('DELETE FROM tp_segments WHERE device=? AND track=?',
+                        (device, track))
+
+    def _delete_trackpoints(self, device, track):
+        for table in ('tp_points', 'tp_packed', 'tp_summary'):
+            self.db.execute('DELETE FROM %s WHERE device=? AND track=?' % \
+                                table, (device, track))
+
+    def _update_summary(self, device, track):
+        self.db.execute('INSERT OR REPLACE INTO tp_summary '
+                        'SELECT device,track,COUNT(*),MIN(alt),MAX(alt),'
+                        'SUM(delta) FROM tp_points WHERE device=? AND track=? '
+                        'GROUP BY device,track', (device, track))
+
+    @staticmethod
+    def _iter_rows(device, track, points, first=0):
+        point = first
+        for tp in points:
             point += 1
-            values = [device, track, point]
-            values.extend(tp)
-            c.execute('INSERT INTO tp_points VALUES (%s)' % sqlparams(values),
-                      values)
-        self.db.commit()
+            yield (device, track, point) + tp
@@ -0,0 +1,96 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class ExportCache(object):
+    """Store of rendered export files, so that exporting a track again with
+       the same settings is a file copy.
+
+       Files are named after a digest of the track, the export format, the
+       export settings and the VERSION of the exporters. The cache database
+       records their size and last use: once the files exceed the size
+       limit, the least recently used ones are evicted. The files of a track
+       are forgotten whenever the track is downloaded again.
+    """
+
+    # version of the rendered output, to be increased whenever the exporters
+    # output changes
+    VERSION = 1
+
+    # settings the rendered output depends on
+    SETTINGS = ('trim', 'simplify', 'tolerance', 'zoffset', 'extrude',
+                'gpx_version', 'lod')
+
+    def __init__(self, cache, path, limit):
+        self.cache = cache
+        self.path = path
+        self.limit = limit
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, device, track, fmt, name, settings):
+        """Compute the key of an export, name being the document name"""
+        values = [self.VERSION, device, track, fmt, name] + \
+                 [settings.get(it) for it in self.SETTINGS]
+        return hashlib.sha1(repr(values)).hexdigest()
+
+    def fetch(self, key, output):
+        """Copy a rendered export to the output file, if it is cached"""
+        if not self.cache.use_export(key):
+            return False
+        try:
+            shutil.copyfile(os.path.join(self.path, key), output)
+        except IOError:
+            # the file has been evicted from another process
+            self.cache.remove_exports([key])
+            return False
+        return True
+
+    def store(self, key, device, track, output):
+        """Keep a copy of a rendered export"""
+        (fd, tmpname) = tempfile.mkstemp(dir=self.path, prefix='.')
+        os.close(fd)
+        try:
+            shutil.copyfile(output, tmpname)
+            # the export is recorded before its file is complete, see fetch
+            self.cache.add_export(key, device, track, os.stat(tmpname).st_size)
+            os.rename(tmpname, os.path.join(self.path, key))
+        finally:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+        self.prune()
+
+    def prune(self):
+        """Evict the least recently used files beyond the size limit, and
+           the files of the tracks that have been downloaded again"""
+        # files are listed first, as exports are recorded before their file
+        # is stored
+        filenames = os.listdir(self.path)
+        exports = self.cache.get_exports()
+        total = sum([size for (key, size) in exports])
+        evicted = []
+        for (key, size) in exports:
+            if total <= self.limit:
+                break
+            evicted.append(key)
+            total -= size
+        if evicted:
+            self.cache.remove_exports(evicted)
+        known = set([key for (key, size) in exports]) - set(evicted)
+        for filename in filenames:
+            # temporary files start with a dot
+            if filename.startswith('.') or filename in known:
+                continue
+            try:
+                os.unlink(os.path.join(self.path, filename))
+            except OSError:
+                pass
@@ -0,0 +1,125 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from binascii import hexlify
+import struct
+
+
+def xor_checksum(data, cksum=0):
+    """Compute the XOR of all the bytes of a buffer.
+
+       The buffer is loaded as a single wide integer, which is then folded
+       in halves until a single byte remains, so that the cost does not
+       depend on per-byte Python code.
+    """
+    size = len(data)
+    if not size:
+        return cksum
+    value = int(hexlify(data), 16)
+    while size > 1:
+        half = (size+1)//2
+        shift = 8*half
+        value = (value >> shift) ^ (value & ((1 << shift)-1))
+        size = half
+    return cksum ^ value
+
+
+class FrameCodec(object):
+    """Encoder and incremental decoder of Keymaze protocol frames
+
+       A frame is made of a command byte, a 16-bit payload length, the
+       payload, and a XOR checksum of the length and payload bytes.
+       Requests are prefixed with an extra start byte.
+
+       Received bytes are accumulated into a preallocated buffer. Decoded
+       payloads are memoryview slices of this buffer, which remain valid
+       until more data is fed into the codec.
+    """
+
+    HEADER = struct.Struct('>BH')
+    REQUEST = struct.Struct('>BHB')
+
+    # largest frame: header, 64KiB payload and checksum
+    MAX_FRAME = HEADER.size+0xffff+1
+
+    def __init__(self, prefix, size=2*MAX_FRAME):
+        self.prefix = prefix
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._head = 0
+        self._tail = 0
+
+    def encode(self, command, params=''):
+        """Build a request frame"""
+        req = bytearray(self.REQUEST.size+len(params)+1)
+        self.REQUEST.pack_into(req, 0, self.prefix, 1+len(params), command)
+        req[self.REQUEST.size:-1] = params
+        req[-1] = xor_checksum(buffer(req, 1, len(req)-2))
+        return str(req)
+
+    def reset(self):
+        """Discard all received bytes"""
+        self._head = 0
+        self._tail = 0
+
+    def available(self):
+        """Count of received bytes not yet decoded"""
+        return self._tail-self._head
+
+    def pending(self):
+        """Received bytes not yet decoded"""
+        return self._view[self._head:self._tail]
+
+    def feed(self, data):
+        """Append received bytes"""
+        size = len(data)
+        if self._head == self._tail:
+            self.reset()
+        if self._tail+size > len(self._buf):
+            # move pending bytes back to the start of the buffer
+            count = self._tail-self._head
+            if count+size > len(self._buf):
+                raise AssertionError('Receive buffer overflow')
+            self._buf[0:count] = self._view[self._head:self._tail].tobytes()
+            self._head = 0
+            self._tail = count
+        self._buf[self._tail:self._tail+size] = data
+        self._tail += size
+
+    def header(self):
+        """Decode the header of the pending frame, if received.
+
+           Return a (command, payload length) tuple, or None
+        """
+        if self.available() < self.HEADER.size:
+            return None
+        return self.HEADER.unpack_from(self._buf, self._head)
+
+    def frame_size(self, length):
+        return self.HEADER.size+length+1
+
+    def decode(self):
+        """Decode the pending frame, if fully received.
+
+           Return a (command, payload) tuple, or None
+        """
+        header = self.header()
+        if not header:
+            return None
+        (command, length) = header
+        size = self.frame_size(length)
+        if self.available() < size:
+            return None
+        start = self._head
+        self._head += size
+        frame = self._view[start:start+size]
+        rcksum = self._buf[start+size-1]
+        dcksum = xor_checksum(frame[1:-1])
+        if rcksum != dcksum:
+            raise AssertionError('Comm. error, checksum error 0x%02x/0x%02x' \
+                                    % (rcksum, dcksum))
+        return (command, frame[self.HEADER.size:-1])
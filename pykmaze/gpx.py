@@ -5,7 +5,8 @@
 # @license MIT License, see LICENSE file
 #-----------------------------------------------------------------------------
 
-from pkg_resources import find_distributions
+from itertools import izip
+from xml.sax.saxutils import escape, quoteattr
 import os
 import sys
 import time
@@ -81,3 +82,107 @@ class GpxDoc(object):
             bounds.set(b, str(self._bounds[b]))
         out.write(ET.tostring(self.root))
 
+
+
+class GpxWriter(object):
+    """Streaming exporter for Topografix GPX file format
+
+       Trackpoints are formatted straight into the output file, as they are
+       added. GPX 1.0 output is identical to the one of GpxDoc. As GPX 1.1
+       expects the bounds in the document header, they are only written out
+       if provided on creation (see Track.bounds).
+    """
+
+    NAMESPACES = { '1.0' : 'http://www.topografix.com/GPX/1/0',
+                   '1.1' : 'http://www.topografix.com/GPX/1/1' }
+
+    # count of trackpoints formatted and written at once
+    CHUNK = 2048
+
+    TRKPT_FMT = '<trkpt lat="%s" lon="%s"><ele>%s</ele><time>%s</time>' \
+                '<sym>Waypoint</sym></trkpt>'
+
+    def __init__(self, out, name, startime, version='1.0', bounds=None,
+                 doctime=None):
+        if version not in self.NAMESPACES:
+            raise AssertionError('Unsupported GPX version %s' % version)
+        self.out = out
+        self.version = version
+        self._time = 10.0*startime
+        self._minute = None
+        self._prefix = ''
+        self._bounds = bounds and dict(bounds) or { 'minlat' : 180.0,
+                                                    'minlon' : 90.0,
+                                                    'maxlat' : -180.0,
+                                                    'maxlon' : -90.0 }
+        pykmaze_ver = "v1.0"
+        namespace = self.NAMESPACES[version]
+        if doctime is None:
+            doctime = time.time()
+        out.write('<?xml version="1.0" encoding="UTF-8"?>')
+        out.write('<gpx creator=%s version="%s" xmlns="%s" '
+                  'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                  'xsi:schemaLocation="%s %s/gpx.xsd">' % \
+                  (quoteattr('PyKmaze %s - http://pykmaze.googlecode.com' % \
+                                 pykmaze_ver),
+                   version, namespace, namespace, namespace))
+        if version == '1.0':
+            out.write('<time>%s</time>' % GpxDoc._mktime(doctime))
+        else:
+            out.write('<metadata><time>%s</time>' % GpxDoc._mktime(doctime))
+            if bounds:
+                self._write_bounds()
+            out.write('</metadata>')
+        out.write('<trk><name>%s</name><number>1</number>' % escape(name))
+
+    def _timestamp(self, timestamp):
+        # consecutive points are usually recorded within the same minute,
+        # only format the seconds
+        minute = timestamp//60
+        if minute != self._minute:
+            self._minute = minute
+            self._prefix = time.strftime('%Y-%m-%dT%H:%M:',
+                                         time.gmtime(60*minute))
+        return '%s%02dZ' % (self._prefix, timestamp-60*minute)
+
+    def add_trackpoints(self, track, zoffset=0):
+        """Write a Track as a track segment"""
+        if not len(track):
+            self.out.write('<trkseg />')
+            return
+        self.out.write('<trkseg>')
+        self.update_bounds(track.bounds())
+        fmt = self.TRKPT_FMT
+        timestamp = self._timestamp
+        scale = track.DEGREE
+        lines = []
+        for (lat, lon, alt, delta) in izip(track.column('lat'),
+                                           track.column('lon'),
+                                           track.column('alt'),
+                                           track.column('delta')):
+            self._time += delta
+            lines.append(fmt % (lat/scale, lon/scale, float(alt+zoffset),
+                                timestamp(int(self._time//10))))
+            if len(lines) >= self.CHUNK:
+                self.out.write(''.join(lines))
+                lines = []
+        self.out.write(''.join(lines))
+        self.out.write('</trkseg>')
+
+    def update_bounds(self, bounds):
+        for b in ('minlat', 'minlon'):
+            self._bounds[b] = min(self._bounds[b], bounds[b])
+        for b in ('maxlat', 'maxlon'):
+            self._bounds[b] = max(self._bounds[b], bounds[b])
+
+    def _write_bounds(self):
+        self.out.write('<bounds %s />' % \
+                       ' '.join(['%s="%s"' % (b, self._bounds[b]) \
+                                    for b in sorted(self._bounds)]))
+
+    def close(self):
+        self.out.write('</trk>')
+        if self.version == '1.0':
+            self._write_bounds()
+        self.out.write('</gpx>')
+
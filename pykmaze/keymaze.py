@@ -10,16 +10,17 @@
 #       warmly welcomed
 #-----------------------------------------------------------------------------
 
+from frame import FrameCodec
+from linkstats import LinkStats
+from prefetch import Prefetcher
+from track import Track
+from capture import CaptureTransport
+from transport import SerialTransport
 from util import hexdump, inttime
 import datetime
 import struct
 import sys
 import time
-try:
-    import serial
-except ImportError:
-    print >> sys.stderr, "Missing serial module"
-    sys.exit(1)
 
 class KeymazePort(object):
     """Interface w/ the Keymaze device, through a serial stream which is itself
@@ -44,9 +45,58 @@ class KeymazePort(object):
     TP_HDR_FMT = 'IIIHHBBI'         # 22
     TP_ENT_FMT = 'iihHHB'           # 15
     INFO_FMT = '12s13x17s11sBBxBxBxBxBx3x3B16x' 
+
+    TP_CAT = struct.Struct('>%s' % TP_CAT_FMT)
+    TP_HDR = struct.Struct('>%s%s' % (TP_CAT_FMT, TP_HDR_FMT))
+    TP_ENT = struct.Struct('>%s' % TP_ENT_FMT)
+    INFO = struct.Struct('>%s' % INFO_FMT)
+    # multi-entry decoders, indexed on the count of entries in a response
+    _TP_ENTS = {}
+
+    # request attempts, and bounds of the response timeouts, in seconds
+    KNOCKS = 4
+    MIN_TIMEOUT = 0.2
+    MAX_TIMEOUT = 2.0
+    # requests that cannot be sent again safely, whose response timeout is
+    # never shortened: a CMD_TP_GET_NEXT request that is sent again moves
+    # on to the next chunk whenever the device did answer the former
+    # request, late
+    SEQUENTIAL = (CMD_TP_GET_HDR, CMD_TP_GET_NEXT)
+    # safety factors applied to the measured latency and throughput
+    LATENCY_MARGIN = 4
+    TRANSFER_MARGIN = 2
+
+    # count of trackpoint responses received ahead of their decoding
+    PREFETCH = 16
+
+    # USB VID:PID of the PL-2303 bridge, and fallback serial port names
+    USB_IDS = ('067B:2303',)
+    PORT_PATTERNS = ('/dev/cu.usbserial*', '/dev/ttyUSB*')
     
-    def __init__(self, log, portname):
+    def __init__(self, log, portname, verbose=True, transport=None,
+                 capture=None):
+        """Open the device port, or use the provided transport, such as a
+           trace replay one. If capture is set, all the traffic is recorded
+           to the capture trace file."""
         self.log = log
+        self.portname = portname
+        self.verbose = verbose
+        if not transport:
+            transport = SerialTransport(self._open_port(portname),
+                                        self.KM_BAUDRATE)
+        if capture:
+            transport = CaptureTransport(transport, capture, self.KM_BAUDRATE)
+        self._transport = transport
+        self.stats = LinkStats(self.KM_BAUDRATE)
+        self._codec = FrameCodec(self.CMD_PREFIX)
+        self._drain()
+
+    def _open_port(self, portname):
+        # the serial stack is only loaded when a device port is used
+        try:
+            import serial
+        except ImportError:
+            raise AssertionError('Missing serial module')
         try:
             try:
                 from serialext import SerialExpander
@@ -54,27 +104,49 @@ class KeymazePort(object):
             except ImportError:
                 print "No pyftdi"
                 serialclass = serial.Serial
-            self._port = serialclass(port=portname,
-                                     baudrate=self.KM_BAUDRATE)
-            if not self._port.isOpen:
-                self._port.open()
+            port = serialclass(port=portname, baudrate=self.KM_BAUDRATE)
+            if not port.isOpen:
+                port.open()
         except serial.serialutil.SerialException:
             raise AssertionError('Cannot open device "%s"' % portname)
-        if not self._port.isOpen():
+        if not port.isOpen():
             raise AssertionError('Cannot open device "%s"' % portname)
-        self._port.setRTS(level=0)
-        self._port.setDTR(level=0)
-        self._drain()
+        try:
+            port.setRTS(level=0)
+            port.setDTR(level=0)
+        except IOError:
+            # pseudo-terminals, such as the simulator one, have no modem
+            # control lines
+            pass
+        return port
             
     def close(self):
-        if self._port and self._port.isOpen:
-            self._port.close()
+        self._transport.close()
+
+    @classmethod
+    def discover(cls):
+        """List the serial ports that seem to be attached to a data cable"""
+        ports = []
+        try:
+            from serial.tools.list_ports import comports
+            for info in comports():
+                (port, desc, hwid) = tuple(info)[:3]
+                for usbid in cls.USB_IDS:
+                    if usbid in hwid.upper():
+                        ports.append(port)
+        except ImportError:
+            pass
+        if not ports:
+            import glob
+            for pattern in cls.PORT_PATTERNS:
+                ports.extend(glob.glob(pattern))
+        return sorted(set(ports))
     
     def get_information(self):
         """Obtaint the device information"""
         (resp, ack) = self._request_device(self.CMD_INFO_GET)
         (name,sn,user,gender,age,x1,weight,x2,height,y,m,d) = \
-            struct.unpack('>%s' % self.INFO_FMT, resp)
+            self.INFO.unpack_from(resp)
         name = name[:name.find('\0')]
         sn = sn[:sn.find('\0')]
         user = user[:user.find('\0')]
@@ -95,15 +167,14 @@ class KeymazePort(object):
         start = 0
         while start < len(resp):
             # New catatalog entry
-            end = start+struct.calcsize('>%s' % self.TP_CAT_FMT)
+            end = start+self.TP_CAT.size
             if end > len(resp):
                 raise AssertionError('Missing data in response %d / %d' % \
-                                        end, len(resp))
+                                        (end, len(resp)))
             # there are 6 trailing bytes whose signification is yet to be
             # discovered, decoded here into the silent variable '_'
             (yy,mm,dd,hh,mn,ss,lap,dtime,dst,kcal,mspd,mhr,ahr,cmi,cmd,
-             _,track,idx) = \
-                struct.unpack('>%s' % self.TP_CAT_FMT, resp[start:end])
+             _,track,idx) = self.TP_CAT.unpack_from(resp, start)
             if lap > 1:
                 raise AssertionError('Multi-lap entries not supported')
             dtime /= 10
@@ -129,22 +200,31 @@ class KeymazePort(object):
         
     def get_trackpoints(self, track):
         """Obtain the trackpoints of an activity"""
+        (tp, chunks) = self.read_trackpoints(track)
+        tp['points'] = Track()
+        for (header, points) in chunks:
+            tp['points'].extend(points)
+        return tp
+
+    def read_trackpoints(self, track):
+        """Start the download of the trackpoints of an activity.
+
+           Return a (header, chunks) tuple, where chunks is an iterator that
+           yields, as soon as each device response is received, a tuple of
+           the raw chunk header and the list of decoded points it carries.
+           The responses are received from a background thread, which runs
+           up to PREFETCH responses ahead of the iteration.
+        """
         (resp, ack) = self._request_device(self.CMD_TP_GET_HDR, 
                                            struct.pack('>HH', 1, track))
-        trackpoints = []
-        start = 0
-        # New catatalog entry
-        end = start+struct.calcsize('>%s%s' % (self.TP_CAT_FMT, 
-                                               self.TP_HDR_FMT))
-        if end > len(resp):
+        if self.TP_HDR.size > len(resp):
             raise AssertionError('Missing data in response %d / %d' % \
-                                    (end, len(resp)))
+                                    (self.TP_HDR.size, len(resp)))
         # there are 6 trailing bytes whose signification is yet to be
         # discovered, decoded here into the silent variable '_'
         (yy,mm,dd,hh,mn,ss,lap,dtime,dst,kcal,mspd,mhr,ahr,cmi,cmd,_,
          track,idx,stop,ttime,tdst,tkcal,tmspd,tmhr,tahr,count) = \
-            struct.unpack('>%s%s' % (self.TP_CAT_FMT, self.TP_HDR_FMT), 
-                          resp[start:end])
+            self.TP_HDR.unpack_from(resp)
         if lap > 1:
             raise AssertionError('Multi-lap entries not supported')
         lap_sec = dtime//10
@@ -158,100 +238,150 @@ class KeymazePort(object):
                'avgheart' : ahr,
                'cmlplus' : cmi,
                'cmlmin' : cmd,
-               'count' : count,
-               'points' : []}
+               'count' : count }
+        if self.verbose:
+            print 'Points: %d' % count
+        self._tp_count = count
+        self._tp_received = 0
+        return (tp, Prefetcher(self._fetch_trackpoints(count), self.PREFETCH,
+                               self._decode_trackpoints, self.portname))
+
+    def _fetch_trackpoints(self, count):
+        """Request the trackpoint chunks, and yield the raw responses.
+
+           Run from the prefetch thread, so that the next chunk is received
+           while the previous ones are decoded and stored.
+        """
         rem_tp = count
-        print 'Points: %d' % count
         while rem_tp > 0:
             (resp, ack) = self._request_device(self.CMD_TP_GET_NEXT,
                                                accept=[self.ACK_TP_GET_NONE,
                                                        self.CMD_TP_GET_HDR])
             if ack == self.ACK_TP_GET_NONE:
                 # no more point
-                return tp
-            start = 0
-            end = start+struct.calcsize('>%s' % self.TP_CAT_FMT)
-            header = struct.unpack('>%s' % self.TP_CAT_FMT, resp[start:end])
-            entry_len = struct.calcsize('>%s' % self.TP_ENT_FMT)
-            start = end
-            points = []
-            while start+entry_len <= len(resp):
-                (x,y,z,s,h,d) = struct.unpack('>%s' % self.TP_ENT_FMT, 
-                                              resp[start:start+entry_len])
-                points.append((x,y,z,s,h,d))
-                rem_tp -= 1
-                start += entry_len
-            tp['points'].extend(points)
-            pc = (50*(count-rem_tp))/count
+                break
+            rem_tp -= (len(resp)-self.TP_CAT.size)//self.TP_ENT.size
+            # the response view is only valid until the next request
+            yield resp.tobytes()
+
+    def _decode_trackpoints(self, resp):
+        # each chunk starts with a copy of the catalog entry
+        (points, end) = self._unpack_entries(resp, self.TP_CAT.size)
+        self._tp_received += len(points)
+        if self.verbose:
+            count = max(self._tp_count, 1)
+            pc = (50*min(self._tp_received, count))/count
             progress = '%s%s: %d%%' % ('+'*pc, '.'*(50-pc), 2*pc)
             print 'TP: ', progress, '\r', 
+            if self._tp_received >= self._tp_count:
+                print ''
             sys.stdout.flush()
-            if start < len(resp):
-                self.log.error("Remaining bytes: %s" % hexdump(resp[start:]))
-        print ''
-        return tp
+        if end < len(resp):
+            self.log.error("Remaining bytes: %s" % hexdump(resp[end:]))
+        return (resp[:self.TP_CAT.size], points)
+
+    def _unpack_entries(self, data, offset):
+        """Decode all the complete trackpoint entries of a response buffer
+           at once, with a single struct call"""
+        count = max(0, (len(data)-offset)//self.TP_ENT.size)
+        try:
+            entries = self._TP_ENTS[count]
+        except KeyError:
+            entries = struct.Struct('>%s' % (self.TP_ENT_FMT*count))
+            self._TP_ENTS[count] = entries
+        values = iter(entries.unpack_from(data, offset))
+        # regroup the flat value sequence into per-point tuples
+        points = zip(*([values]*len(self.TP_ENT_FMT)))
+        return (points, offset+entries.size)
 
     def _request_device(self, command, params='', accept=[], debug=False):
-        req = struct.pack('>BHB', self.CMD_PREFIX, 1+len(params), command)
-        req += params
-        req += struct.pack('>B', self._calc_checksum(req[1:]))
-        self._port.timeout = 2
-        resp_h = None
-        accept.append(command)
-        for knock in range(4):
-            self._drain()
+        """Send a request, and return the (payload, command) of the device
+           response. The payload is a view on the receive buffer, which is
+           only valid until the next request"""
+        req = self._codec.encode(command, params)
+        header = None
+        accept = list(accept) + [command]
+        stats = self.stats
+        for knock in range(self.KNOCKS):
+            if knock:
+                stats.add_retry()
+            # only wait for the line to settle down when retrying
+            self._drain(wait=knock > 0)
             if debug:
                 self.log.debug("Write:\n%s" % hexdump(req))
-            self._port.write(req)
-            resp_h = self._port.read(3)
-            if len(resp_h) < 3:
+            sent = time.time()
+            self._transport.write(req)
+            # exponential backoff on retries, up to the longest timeout
+            header = self._receive(self._codec.HEADER.size,
+                                   min(self.MAX_TIMEOUT,
+                                       self._header_timeout(command) * \
+                                           (1 << knock)))
+            if not header:
+                stats.add_timeout()
                 continue
-            (cmd, resp_len) = struct.unpack('>BH', resp_h)
+            (cmd, resp_len) = header
             if cmd not in accept:
-                self.log.error('Unexpected response %s' % hexdump(resp_h))
-                self._drain()
+                self.log.error('Unexpected response %s' % \
+                    hexdump(self._codec.pending()[:self._codec.HEADER.size]))
+                header = None
                 continue
             break
-        if not resp_h:
-            raise AssertionError('No answer from device')
-        if len(resp_h) < 3:
+        if not header:
+            if not self._codec.available():
+                raise AssertionError('No answer from device')
             raise AssertionError('Communication error')
+        received = time.time()
         if debug:
             self.log.debug('%d bytes to receive' % resp_len)
-        resp = self._port.read(resp_len)
-        cksum = self._port.read(1)
+        # leave time for the whole payload to be transmitted
+        size = self._codec.frame_size(resp_len)
+        self._receive(size, self._payload_timeout(size))
+        try:
+            frame = self._codec.decode()
+        except AssertionError:
+            stats.add_checksum_error()
+            raise
+        if not frame:
+            stats.add_timeout()
+            raise AssertionError('Communication error')
+        now = time.time()
+        stats.add_round_trip(len(req), size, received-sent, now-received,
+                             command)
+        (cmd, resp) = frame
         if debug:
             self.log.debug("Read:\n%s" % hexdump(resp))
-        self._port.timeout = 1
-        if not len(cksum):
-            raise AssertionError('Communication error')
-        rcksum = ord(cksum)
-        dcksum = self._calc_checksum(resp_h[1:], resp)
-        if rcksum != dcksum:
-            raise AssertionError('Comm. error, checksum error 0x%02x/0x%02x' \
-                                    % (rcksum, dcksum))
         return (resp, cmd)
-    
-    def _calc_checksum(self, *args):
-        """Compute the (NMEA) checksum for an outgoing packet"""
-        cksum = 0x0
-        for data in args:
-            for b in data:
-                cksum ^= ord(b)
-        return cksum
 
-    def _drain(self):
-        """Drain the serial RX FIFO to remove all received bytes"""
-        timeout = self._port.timeout
-        while True:
-            try:
-                time.sleep(0.01)
-                rem = self._port.inWaiting()
-            except IOError:
-                rem = 0
-            for ch in range(rem):
-                self._port.read()
-            if not rem:
+    def _header_timeout(self, command=None):
+        """Time to wait for the response header of a command, from the
+           observed device latency"""
+        latency = self.stats.latency(command)
+        if latency is None or command in self.SEQUENTIAL:
+            return self.MAX_TIMEOUT
+        return min(self.MAX_TIMEOUT,
+                   max(self.MIN_TIMEOUT, self.LATENCY_MARGIN*latency))
+
+    def _payload_timeout(self, size):
+        """Time to wait for a frame of size bytes, from the observed link
+           throughput"""
+        return max(self.MIN_TIMEOUT,
+                   self.TRANSFER_MARGIN*size/self.stats.throughput())
+
+    def _receive(self, size, timeout):
+        """Receive at least size bytes, reading ahead whatever is available.
+           Return the header of the pending frame, if any"""
+        deadline = time.time()+timeout
+        while self._codec.available() < size:
+            remaining = deadline-time.time()
+            if remaining <= 0:
+                break
+            data = self._transport.recv(self._codec.MAX_FRAME, remaining)
+            if not data:
                 break
-        # restore timeout
-        self._port.timeout = timeout
+            self._codec.feed(data)
+        return self._codec.header()
+    
+    def _drain(self, wait=True):
+        """Drain the serial RX FIFO to remove all received bytes"""
+        self._codec.reset()
+        self._transport.drain(wait)
@@ -5,7 +5,19 @@
 # @license MIT License, see LICENSE file
 #-----------------------------------------------------------------------------
 
+from bisect import bisect_left
+from contextlib import contextmanager
+from cStringIO import StringIO
+from itertools import izip
+from xml.sax.saxutils import escape, quoteattr
+import math
+import os
+import tempfile
 import xml.etree.ElementTree as ET
+import zipfile
+
+# length of a degree of latitude, in meters
+DEGREE_LENGTH = 6371.0*1000*math.pi/180
 
 class KmlDoc(object):
     """Importer/Exporter for Google KML file format
@@ -49,3 +61,175 @@ class KmlDoc(object):
                 ET.SubElement(linestyle, k).text = v
         out.write(ET.tostring(self.root))
 
+
+class KmlWriter(object):
+    """Streaming exporter for Google KML file format
+
+       The document is written to the output file as trackpoints are
+       added, so that memory usage does not depend on the track length.
+    """
+
+    # count of coordinates formatted and written at once
+    CHUNK = 2048
+
+    def __init__(self, out, name, zoffset=0, extrude=True, tessellate=True,
+                 color='7f7f00ff', width='8'):
+        self.out = out
+        self.zoffset = zoffset
+        self._first = True
+        self._style = (('color', color), ('width', width))
+        sid = '_'.join(['%s%s' % (k,v) for (k,v) in self._style])
+        out.write('<?xml version="1.0" encoding="UTF-8"?>')
+        out.write('<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+                  '<Placemark><name>%s</name><styleUrl>#%s</styleUrl>'
+                  '<LineString><extrude>%s</extrude>'
+                  '<tessellate>%s</tessellate>'
+                  '<altitudeMode>absolute</altitudeMode><coordinates>' % \
+                  (escape(name), escape(sid), extrude and '1' or '0', 
+                   tessellate and '1' or '0'))
+        self._sid = sid
+
+    def add_trackpoints(self, track):
+        """Write the coordinates of a Track"""
+        zoffset = self.zoffset
+        scale = track.DEGREE
+        lat = track.column('lat')
+        lon = track.column('lon')
+        alt = track.column('alt')
+        for pos in xrange(0, len(track), self.CHUNK):
+            end = pos+self.CHUNK
+            text = '\n'.join(['%.6f,%.6f,%d' % (x/scale, y/scale, z+zoffset) \
+                                  for (y, x, z) in izip(lat[pos:end],
+                                                        lon[pos:end],
+                                                        alt[pos:end])])
+            if not self._first:
+                self.out.write('\n')
+            self._first = False
+            self.out.write(text)
+
+    def close(self):
+        self.out.write('</coordinates></LineString></Placemark>')
+        self.out.write('<Style id=%s><LineStyle>' % quoteattr(self._sid))
+        for (k,v) in self._style:
+            self.out.write('<%s>%s</%s>' % (k, escape(v), k))
+        self.out.write('</LineStyle></Style></Document></kml>')
+
+
+@contextmanager
+def kmz_output(path, name='doc.kml'):
+    """Provide a file object to write the KML document of a KMZ archive.
+
+       The document is spooled to a temporary file next to the archive, then
+       deflated into the archive chunk by chunk.
+    """
+    tmp = tempfile.NamedTemporaryFile(suffix='.kml',
+                                      dir=os.path.dirname(path) or '.')
+    try:
+        yield tmp
+        tmp.flush()
+        kmz = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            kmz.write(tmp.name, name)
+        finally:
+            kmz.close()
+    finally:
+        tmp.close()
+
+
+class KmzLodWriter(object):
+    """Exporter of a track as a KMZ archive of level of detail tiles
+
+       The track is split into tiles of TILE trackpoints. Each level of
+       detail of a tile is a KML document of the archive, which the main
+       document loads with a NetworkLink once the Region of the tile is
+       shown large enough on screen for this level, and drops once it is
+       large enough for the next, finer, level. The last level is the full
+       resolution track.
+    """
+
+    # count of trackpoints of each tile
+    TILE = 1024
+
+    # display error allowed for a level of detail, in pixels
+    PIXEL_ERROR = 2
+
+    def __init__(self, path, name, zoffset=0, extrude=True):
+        self.path = path
+        self.name = name
+        self.zoffset = zoffset
+        self.extrude = extrude
+
+    def write(self, track, levels):
+        """Write a Track with its levels of detail, given as (tolerance,
+           indices) pairs, coarsest first (see KeymazeCache.get_lod)"""
+        links = []
+        tiles = []
+        # each level is taken from the track once for all, tiles are views
+        levels = [(tolerance, indices, track.take(indices)) \
+                      for (tolerance, indices) in levels]
+        for start in xrange(0, len(track), self.TILE):
+            stop = min(start+self.TILE, len(track))
+            self._add_tile(links, tiles, track, levels, start, stop)
+        kmz = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            # viewers open the first document of the archive
+            kmz.writestr('doc.kml',
+                         '<?xml version="1.0" encoding="UTF-8"?>'
+                         '<kml xmlns="http://www.opengis.net/kml/2.2">'
+                         '<Document><name>%s</name>%s</Document></kml>\n' % \
+                             (escape(self.name), ''.join(links)))
+            for (href, data) in tiles:
+                kmz.writestr(href, data)
+        finally:
+            kmz.close()
+
+    def _add_tile(self, links, tiles, track, levels, start, stop):
+        """Build the documents of the levels of detail of a tile, and the
+           NetworkLinks that load them"""
+        # tiles start from the last point of the former tile, so that they
+        # join up
+        first = max(start-1, 0)
+        bounds = track[first:stop].bounds()
+        size = self._size(bounds)
+        minpixels = 0
+        for (level, (tolerance, indices, points)) in \
+                enumerate(levels+[(None, None, None)]):
+            if indices is None:
+                tile = track[first:stop]
+                maxpixels = -1
+            else:
+                lo = max(bisect_left(indices, start)-1, 0)
+                tile = points[lo:bisect_left(indices, stop)]
+                maxpixels = int(size*self.PIXEL_ERROR/tolerance)
+                if maxpixels <= minpixels:
+                    # the tile is too small for this level to show up
+                    continue
+            href = 'tiles/%d-%d.kml' % (start//self.TILE, level)
+            out = StringIO()
+            kml = KmlWriter(out, '%s %d-%d' % (self.name, start//self.TILE,
+                                               level),
+                            self.zoffset, extrude=self.extrude)
+            kml.add_trackpoints(tile)
+            kml.close()
+            tiles.append((href, out.getvalue()))
+            links.append('<NetworkLink><Region><LatLonAltBox>'
+                         '<north>%.6f</north><south>%.6f</south>'
+                         '<east>%.6f</east><west>%.6f</west>'
+                         '</LatLonAltBox><Lod><minLodPixels>%d</minLodPixels>'
+                         '<maxLodPixels>%d</maxLodPixels></Lod></Region>'
+                         '<Link><href>%s</href>'
+                         '<viewRefreshMode>onRegion</viewRefreshMode>'
+                         '</Link></NetworkLink>' % \
+                             (bounds['maxlat'], bounds['minlat'],
+                              bounds['maxlon'], bounds['minlon'],
+                              minpixels, maxpixels, href))
+            minpixels = maxpixels
+
+    @staticmethod
+    def _size(bounds):
+        """Approximate size of the tile region, in meters"""
+        lat = math.radians((bounds['minlat']+bounds['maxlat'])/2)
+        height = (bounds['maxlat']-bounds['minlat'])*DEGREE_LENGTH
+        width = (bounds['maxlon']-bounds['minlon'])*DEGREE_LENGTH* \
+            math.cos(lat)
+        return max(width, height)
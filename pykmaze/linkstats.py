@@ -0,0 +1,111 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from bisect import bisect_left
+import time
+
+
+class LinkStats(object):
+    """Link quality counters of a device session.
+
+       Also provide the estimates of the device response latency and of the
+       link throughput, from which request timeouts are derived.
+    """
+
+    # upper bounds, in milliseconds, of the latency histogram buckets
+    LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+    # weight of the last sample in the latency estimate
+    LATENCY_WEIGHT = 0.25
+
+    def __init__(self, baudrate):
+        # nominal throughput, until it is measured
+        self.baudrate = baudrate
+        self.start = time.time()
+        self.round_trips = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.checksum_errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.histogram = [0]*(len(self.LATENCY_BUCKETS)+1)
+        self._latency = None
+        # latency estimates, indexed on request command
+        self._latencies = {}
+        self._transfer_bytes = 0
+        self._transfer_time = 0.0
+
+    def add_round_trip(self, sent, received, latency, transfer,
+                       command=None):
+        """Record a completed request: the byte counts, the delay before the
+           response header, and the time to receive the rest of the frame.
+           The latency is also accounted for the request command, if any"""
+        self.round_trips += 1
+        self.bytes_sent += sent
+        self.bytes_received += received
+        bucket = bisect_left(self.LATENCY_BUCKETS, 1000*latency)
+        self.histogram[bucket] += 1
+        self._latency = self._average(self._latency, latency)
+        if command is not None:
+            self._latencies[command] = \
+                self._average(self._latencies.get(command), latency)
+        self._transfer_bytes += received
+        self._transfer_time += transfer
+
+    def add_retry(self):
+        self.retries += 1
+
+    def add_timeout(self):
+        self.timeouts += 1
+
+    def add_checksum_error(self):
+        self.checksum_errors += 1
+
+    def _average(self, estimate, latency):
+        if estimate is None:
+            return latency
+        return estimate+self.LATENCY_WEIGHT*(latency-estimate)
+
+    def latency(self, command=None):
+        """Estimated response latency in seconds, or None if unknown. The
+           latency of a command is the one of its own responses, once some
+           have been received"""
+        if command in self._latencies:
+            return self._latencies[command]
+        return self._latency
+
+    def throughput(self):
+        """Estimated reception throughput, in bytes per second"""
+        nominal = self.baudrate/10.0
+        if self._transfer_time <= 0 or self._transfer_bytes < 1024:
+            return nominal
+        # the read-ahead may hide part of the transfer time: never trust
+        # more than the nominal link speed
+        return min(nominal, self._transfer_bytes/self._transfer_time)
+
+    def report(self):
+        """Return the counters as a dictionary"""
+        elapsed = time.time()-self.start
+        histogram = []
+        for (bound, count) in zip(self.LATENCY_BUCKETS+(None,),
+                                  self.histogram):
+            histogram.append({'max_ms': bound, 'count': count})
+        return { 'elapsed' : elapsed,
+                 'round_trips' : self.round_trips,
+                 'retries' : self.retries,
+                 'timeouts' : self.timeouts,
+                 'checksum_errors' : self.checksum_errors,
+                 'bytes_sent' : self.bytes_sent,
+                 'bytes_received' : self.bytes_received,
+                 'bytes_per_second' : elapsed and \
+                    (self.bytes_sent+self.bytes_received)/elapsed or 0,
+                 'throughput' : self.throughput(),
+                 'latency' : self._latency,
+                 'command_latency' : dict([('0x%02x' % cmd, latency) \
+                                           for (cmd, latency) in \
+                                               self._latencies.items()]),
+                 'latency_histogram' : histogram }
@@ -0,0 +1,99 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from array import array
+import zlib
+
+# numpy module, once imported, or False if it is not available
+_numpy = None
+
+# Integer columns are stored as the zigzag-encoded difference between
+# consecutive values, each difference being written as a little-endian base
+# 128 varint. Trackpoint values change slowly from one point to the next, so
+# most of them fit in a single byte.
+
+def pack_column(values, compress=False):
+    """Encode a sequence of integers into a binary string"""
+    out = array('B')
+    append = out.append
+    last = 0
+    for value in values:
+        delta = value-last
+        last = value
+        zz = (delta << 1) ^ (delta >> 63)
+        while zz > 0x7f:
+            append(0x80 | (zz & 0x7f))
+            zz >>= 7
+        append(zz)
+    data = out.tostring()
+    if compress:
+        data = zlib.compress(data)
+    return data
+
+def unpack_column(data, count, compress=False):
+    """Decode a binary string into an array of count integers"""
+    if compress:
+        data = zlib.decompress(data)
+    numpy = _import_numpy()
+    if numpy:
+        return _unpack_numpy(numpy, data, count)
+    values = array('i', [0])*count
+    pos = 0
+    value = 0
+    zz = 0
+    shift = 0
+    for byte in array('B', data):
+        zz |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        value += (zz >> 1) ^ -(zz & 1)
+        try:
+            values[pos] = value
+        except IndexError:
+            raise AssertionError('Corrupted column: more than %d values' % \
+                                    count)
+        pos += 1
+        zz = 0
+        shift = 0
+    if pos != count:
+        raise AssertionError('Corrupted column: %d / %d values' % \
+                                (pos, count))
+    return values
+
+def _import_numpy():
+    """Import numpy on first use, as it is slow to load"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy
+
+def _unpack_numpy(numpy, data, count):
+    raw = numpy.frombuffer(data, dtype=numpy.uint8)
+    last = raw < 0x80
+    if int(last.sum()) != count:
+        raise AssertionError('Corrupted column: %d / %d values' % \
+                                (int(last.sum()), count))
+    values = array('i')
+    if not count:
+        return values
+    # index of the first byte of each varint, and rank of each byte within
+    # its varint
+    ends = numpy.flatnonzero(last)
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1]+1
+    rank = numpy.arange(len(raw))-numpy.repeat(starts, ends-starts+1)
+    parts = (raw & 0x7f).astype(numpy.int64) << (7*rank)
+    zz = numpy.add.reduceat(parts, starts)
+    deltas = (zz >> 1) ^ -(zz & 1)
+    values.fromstring(numpy.cumsum(deltas).astype(numpy.intc).tostring())
+    return values
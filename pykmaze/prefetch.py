@@ -0,0 +1,91 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import Queue
+import sys
+import threading
+
+
+class Prefetcher(object):
+    """Iterate over the items of a producer, which runs ahead from a
+       background thread.
+
+       Up to size produced items are buffered, after which the producer is
+       blocked until the consumer catches up. An optional convert function
+       is applied to each item from the consumer thread. An exception raised
+       by the producer is raised again from the consumer thread, once the
+       items produced before it have been consumed.
+    """
+
+    # period at which a blocked producer checks whether it should stop
+    POLL_TIME = 0.1
+
+    def __init__(self, producer, size, convert=None, name=None):
+        self._queue = Queue.Queue(size)
+        self._convert = convert
+        self._stop = threading.Event()
+        # set once the producer has ended, before the end or error entry is
+        # queued
+        self._ended = False
+        self._done = False
+        self._thread = threading.Thread(target=self._run, args=(producer,),
+                                        name=name or 'Prefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._done:
+            raise StopIteration
+        (kind, item) = self._queue.get()
+        if kind == 'item':
+            if self._convert:
+                return self._convert(item)
+            return item
+        self._done = True
+        self._thread.join()
+        if kind == 'error':
+            raise item[0], item[1], item[2]
+        raise StopIteration
+
+    def ready(self):
+        """Count of the produced items that are waiting to be consumed. The
+           end of the producer is not an item"""
+        return max(0, self._queue.qsize()-int(self._ended))
+
+    def close(self):
+        """Stop the producer, and discard the pending items"""
+        self._stop.set()
+        while self._thread.isAlive():
+            try:
+                self._queue.get(timeout=self.POLL_TIME)
+            except Queue.Empty:
+                pass
+        self._done = True
+
+    def _run(self, producer):
+        try:
+            for item in producer:
+                if not self._put(('item', item)):
+                    return
+        except Exception:
+            self._ended = True
+            self._put(('error', sys.exc_info()))
+            return
+        self._ended = True
+        self._put(('end', None))
+
+    def _put(self, entry):
+        while not self._stop.isSet():
+            try:
+                self._queue.put(entry, timeout=self.POLL_TIME)
+                return True
+            except Queue.Full:
+                pass
+        return False
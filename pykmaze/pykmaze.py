@@ -8,14 +8,16 @@
 #-----------------------------------------------------------------------------
 
 from __future__ import with_statement
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import imap
 from optparse import OptionParser
 from db import KeymazeCache
-from keymaze import KeymazePort
 import datetime
 import logging
-import math
 import os
 import re
+import threading
 import time
 import sys
 
@@ -40,7 +42,7 @@ def show_trackpoints_catalog(cat):
              tpent['altmax'] and '%6dm' % tpent['altmax'] or '      -')
 
 def parse_trim(trim_times):
-    tcre = re.compile(r'^(?P<r>[+-])?'
+    tcre = re.compile(r'^(?:(?P<d>\d{4}-\d\d-\d\d)[T ]|(?P<r>[+-]))?'
                       r'(?:(?P<h>\d\d):(?=\d\d:))?'
                       r'(?:(?P<m>\d\d):)?'
                       r'(?P<s>\d\d)$')
@@ -52,103 +54,443 @@ def parse_trim(trim_times):
         seconds = 60*int(mo.group('h') or 0)
         seconds = 60*(seconds + int(mo.group('m') or 0))
         seconds += int(mo.group('s') or 0)
-        values.append((mo.group('r'), seconds))
+        if mo.group('d'):
+            # absolute local date and time, as a timestamp
+            day = time.strptime(mo.group('d'), '%Y-%m-%d')
+            values.append(('@', int(time.mktime(day))+seconds))
+        else:
+            values.append((mo.group('r'), seconds))
     return values
 
-def trim_trackpoints(track, tp, trims):
-    if not trims:
-        return tp
+def parse_area(bbox=None, near=None):
+    """Parse a minlat,minlon,maxlat,maxlon bounding box or a
+       lat,lon[,radius] position into find_tracks arguments"""
+    text = bbox or near
+    try:
+        values = [float(v) for v in text.split(',')]
+    except ValueError:
+        values = []
+    if bbox and len(values) == 4:
+        return ('box', values)
+    if near and len(values) in (2, 3):
+        if len(values) == 2:
+            # default radius, in meters
+            values.append(100.0)
+        return ('near', values)
+    raise AssertionError('Invalid area "%s"' % text)
+
+def find_area_tracks(cache, device, area):
+    """Find the cached tracks that cross an area, as a dictionary of point
+       ranges indexed on track numbers"""
+    (kind, values) = area
+    if kind == 'near':
+        (lat, lon, radius) = values
+        found = cache.find_tracks_near(lat, lon, radius, device)
+    else:
+        (minlat, minlon, maxlat, maxlon) = values
+        found = cache.find_tracks(minlat, minlon, maxlat, maxlon, device)
+    return dict([(track, ranges) for (dev, track, ranges) in found])
+
+def show_area_tracks(tpcat, matches):
+    print " #   Day         Start  Points"
+    for tpent in sorted(tpcat, key=lambda e: e['id']):
+        if tpent['track'] not in matches:
+            continue
+        stime = time.localtime(tpent['start'])
+        print ' %02d  %s  %s  %s' % \
+            (tpent['id']+1,
+             time.strftime('%Y-%m-%d', stime),
+             time.strftime('%H:%M', stime),
+             ', '.join(['%d-%d' % (first+1, stop) \
+                           for (first, stop) in matches[tpent['track']]]))
+
+def show_rollups(period, rollups):
+    print ' %-8s  Tracks  Distance      Time   Kcal   Climb' % period.title()
+    for total in rollups:
+        print ' %-8s  %6d  %6.1fkm  %4dh%02dm  %5d  %5dm' % \
+            (total['key'], total['count'], total['distance']/1000.0,
+             total['time']//3600, (total['time']//60)%60, total['kcal'],
+             total['climb'])
+
+def show_analytics(track_info, stats):
+    from analytics import HEART_ZONES, SPLIT
+    stime = time.localtime(track_info['start'])
+    print 'Track %02d  %s' % (track_info['id']+1,
+                              time.strftime('%Y-%m-%d %H:%M', stime))
+    print ' Distance: %8.2fkm' % (stats['distance']/1000.0)
+    print ' Climb:    %8dm' % stats['climb']
+    print ' Descent:  %8dm' % stats['descent']
+    for (pos, duration) in enumerate(stats['splits']):
+        seconds = duration/10.0
+        print ' Split %3d: %8s  %6.2fkm/h' % \
+            (pos+1, '%d:%02d' % divmod(int(seconds), 60),
+             3.6*SPLIT/max(seconds, 0.1))
+    total = sum(stats['zones']) or 1
+    bounds = (0,)+HEART_ZONES+(None,)
+    for (pos, duration) in enumerate(stats['zones']):
+        print ' Zone %d %s: %5.1f%%' % \
+            (pos+1, bounds[pos+1] and '%3d-%3d%%' % bounds[pos:pos+2] or \
+                        '%3d%%+   ' % bounds[pos], 100.0*duration/total)
+    print ''
+
+def time_index(track, tp):
+    """Compute the timestamp of each point, in tenths of second"""
+    try:
+        import numpy
+    except ImportError:
+        times = array('l')
+        pt = track['start']*10
+        for delta in tp.column('delta'):
+            pt += delta
+            times.append(pt)
+        return times
+    times = numpy.cumsum(tp.numpy('delta'), dtype=numpy.int64)
+    times += track['start']*10
+    return times
+
+def trim_time(track, trim, default):
+    """Convert a trim value into a timestamp"""
+    (sign, value) = trim
     start = track['start']
     end = start + track['time']
-    if len(trims) > 1:
-        tstart = trims[0]
-        tend = trims[1]
-    else:
-        tstart = trims[0]
-        tend = ('', 0)
-    if tstart[0] == '+':
-        t_start = start+tstart[1]
-    elif tstart[0] == '-':
-        t_start = end-tstart[1]
+    if sign == '+':
+        return start+value
+    if sign == '-':
+        return end-value
+    if sign == '@':
+        return value
+    if value is None:
+        return default
+    # time of the day, on the day the track started
+    day = time.localtime(start)
+    t_abs = int(time.mktime(day[:3]+(0,0,0)+day[6:8]+(-1,)))+value
+    if t_abs < start and t_abs+24*3600 <= end:
+        # the track spans over midnight
+        t_abs += 24*3600
+    return t_abs
+
+def trim_trackpoints(track, tp, trims, times=None):
+    """Keep the trackpoints within the trim bounds. times is the time
+       index of the trackpoints, which is computed if not provided"""
+    if not trims:
+        return tp
+    (first, last) = trim_range(track, tp, trims, times)
+    return tp[first:last]
+
+def trim_range(track, tp, trims, times=None):
+    """Compute the range of the indices of the trackpoints within the trim
+       bounds"""
+    if times is None:
+        times = time_index(track, tp)
+    tstart = trims[0]
+    tend = len(trims) > 1 and trims[1] or ('', None)
+    t_start = trim_time(track, tstart, track['start'])
+    t_end = trim_time(track, tend, track['start']+track['time'])
+    # time index is sorted, as time deltas cannot be negative
+    first = bisect_left(times, t_start*10)
+    last = bisect_right(times, t_end*10)
+    return (first, max(first, last))
+
+def trim_lod(levels, first, last):
+    """Restrict levels of detail to a range of trackpoints, whose indices
+       are shifted to the start of the range. Both ends of the range are
+       kept at each level"""
+    if last-first < 2:
+        return [(tolerance, range(last-first)) for (tolerance, indices) \
+                    in levels]
+    trimmed = []
+    for (tolerance, indices) in levels:
+        inner = indices[bisect_right(indices, first):
+                            bisect_left(indices, last-1)]
+        trimmed.append((tolerance, [0]+[pos-first for pos in inner]+ \
+                                       [last-1-first]))
+    return trimmed
+    
+def write_kml(out, name, points, zoffset, extrude):
+    from kml import KmlWriter
+    kml = KmlWriter(out, name, zoffset, extrude=extrude)
+    kml.add_trackpoints(points)
+    kml.close()
+    out.write('\n')
+
+def write_gpx(out, name, start, points, zoffset, version):
+    from gpx import GpxWriter
+    bounds = None
+    if version != '1.0' and len(points):
+        bounds = points.bounds()
+    gpx = GpxWriter(out, name, start, version, bounds)
+    gpx.add_trackpoints(points, zoffset)
+    gpx.close()
+    out.write('\n')
+
+def export_names(outputs):
+    """Name the document of each output file, after the file name. KML and
+       KMZ documents share the same name"""
+    km = outputs.get('kml') or outputs.get('kmz')
+    names = {}
+    for (fmt, path) in outputs.items():
+        if fmt != 'gpx':
+            path = km
+        names[fmt] = os.path.splitext(os.path.basename(path))[0]
+    return names
+
+def export_track(cache, device, track_info, outputs, settings):
+    """Export a cached track to the output files, indexed on their format,
+       reusing the files rendered by former exports if the export cache is
+       enabled"""
+    log = cache.log
+    track = track_info['track']
+    names = export_names(outputs)
+    exports = None
+    if settings['exports']:
+        from exportcache import ExportCache
+        exports = ExportCache(cache, *settings['exports'])
+    keys = {}
+    pending = {}
+    for (fmt, path) in outputs.items():
+        if exports:
+            keys[fmt] = exports.key(device, track, fmt, names[fmt], settings)
+            if exports.fetch(keys[fmt], path):
+                log.info('Reused the cached %s export' % fmt.upper())
+                continue
+        pending[fmt] = path
+    if not pending:
+        return
+    render_track(cache, device, track_info, pending, names, settings)
+    if exports:
+        for (fmt, path) in pending.items():
+            exports.store(keys[fmt], device, track, path)
+
+def render_track(cache, device, track_info, outputs, names, settings):
+    """Render a cached track to the output files, indexed on their format,
+       with the document names indexed the same way"""
+    log = cache.log
+    tpoints = cache.get_trackpoints(device, track_info['track'])
+    if settings['lod'] and outputs.get('kmz'):
+        levels = cache.get_lod(device, track_info['track'])
+    (first, last) = (0, len(tpoints))
+    if settings['trim']:
+        trims = parse_trim(settings['trim'].split(','))
+        log.info('All points: %d' % len(tpoints))
+        (first, last) = trim_range(track_info, tpoints, trims)
+        tpoints = tpoints[first:last]
+        log.info('Filtered points: %d' % len(tpoints))
+    optpoints = optimize(tpoints, settings['simplify'], settings['tolerance'])
+    log.info('Count: %u, opt: %u', len(tpoints), len(optpoints))
+    zoffset = settings['zoffset']
+    if outputs.get('kmz') and settings['lod']:
+        # the levels of detail replace the simplified track
+        from kml import KmzLodWriter
+        kmz = KmzLodWriter(outputs['kmz'], names['kmz'], zoffset,
+                           settings['extrude'])
+        kmz.write(tpoints, trim_lod(levels, first, last))
+    elif outputs.get('kmz'):
+        from kml import kmz_output
+        with kmz_output(outputs['kmz']) as out:
+            write_kml(out, names['kmz'], optpoints, zoffset,
+                      settings['extrude'])
+    if outputs.get('kml'):
+        with open(outputs['kml'], 'wt') as out:
+            write_kml(out, names['kml'], optpoints, zoffset,
+                      settings['extrude'])
+    if outputs.get('gpx'):
+        with open(outputs['gpx'], 'wt') as out:
+            write_gpx(out, names['gpx'], track_info['start'], optpoints,
+                      zoffset, settings['gpx_version'])
+
+def select_tracks(tpcat, track, dates=None):
+    """Select catalog entries from a track number or 'all', and an
+       optional date range"""
+    if track in ['all']:
+        tracks = list(tpcat)
     else:
-        # not yet implemented
-        t_start = start
-    if tend[0] == '+':
-        t_end = start+tend[1]
-    elif tend[0] == '-':
-        t_end = end-tend[1]
+        tracks = [tp for tp in tpcat if int(tp['id']) == int(track)-1]
+        if not tracks:
+            raise AssertionError('Track "%s" does not exist' % track)
+    if dates:
+        days = dates.split(',')
+        try:
+            first = int(time.mktime(time.strptime(days[0], '%Y-%m-%d')))
+            last = int(time.mktime(time.strptime(days[-1], '%Y-%m-%d')))
+        except ValueError:
+            raise AssertionError('Invalid date range "%s"' % dates)
+        # last day is included
+        last += 24*3600
+        tracks = [tp for tp in tracks if first <= tp['start'] < last]
+        if not tracks:
+            raise AssertionError('No track within "%s"' % dates)
+    tracks.sort(key=lambda e: e['id'])
+    return tracks
+
+def batch_output(path, track_info):
+    """Name the output file of a track exported along with other tracks"""
+    if '%(' not in path:
+        (base, ext) = os.path.splitext(path)
+        path = '%s-%%(date)s%s' % (base, ext)
+    # any other percent sign is part of the file name
+    fmt = re.sub(r'%(?!\()', '%%', path)
+    try:
+        return fmt % { 'id' : int(track_info['id'])+1,
+                       'track' : track_info['track'],
+                       'date' : time.strftime('%Y%m%d-%H%M',
+                                    time.localtime(track_info['start'])) }
+    except (KeyError, ValueError, TypeError):
+        raise AssertionError('Invalid output file name "%s"' % path)
+
+def _export_worker(args):
+    (storage, device, track_info, outputs, settings) = args
+    log = logging.getLogger('pykmaze')
+    try:
+        # each worker uses its own connection to the cache
+        cache = KeymazeCache(log, storage)
+        export_track(cache, device, track_info, outputs, settings)
+    except AssertionError, e:
+        return (track_info, e[0])
+    except Exception, e:
+        # a track that fails to export does not stop the other exports
+        log.debug('Track %d export failure' % (int(track_info['id'])+1),
+                  exc_info=True)
+        return (track_info, 'Unexpected error: %s' % e)
+    return (track_info, None)
+
+def batch_export(log, storage, device, tracks, outputs, settings, jobs):
+    """Export several cached tracks, each to its own set of output files"""
+    works = []
+    for tp in tracks:
+        track_outputs = {}
+        for (fmt, path) in outputs.items():
+            track_outputs[fmt] = batch_output(path, tp)
+        works.append((storage, device, tp, track_outputs, settings))
+    pool = None
+    if not jobs:
+        from multiprocessing import cpu_count
+        jobs = cpu_count()
+    if jobs > 1 and len(works) > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(jobs, len(works)))
+        results = pool.imap_unordered(_export_worker, works)
     else:
-        # not yet implemented
-        t_end = end
-    ttp = []
-    pt = start*10
-    t_start *= 10
-    t_end *= 10
-    for p in tp:
-        pt += p[-1] # delta
-        if t_start <= pt <= t_end:
-            ttp.append(p)
-    return ttp
-    
-def haversine(pt1, pt2):
-    (lat1, lon1) = map(math.radians, pt1[0:2])
-    (lat2, lon2) = map(math.radians, pt2[0:2])
-    R = 6371.0*1000 # m
-    # Mean radius        6,371.0 km
-    # Equatorial radius  6,378.1 km
-    # Polar radius       6,356.8 km
-    dlat = lat2-lat1
-    dlon = lon2-lon1 
-    a = math.sin(dlat/2) * math.sin(dlat/2) + \
-        math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2) * math.sin(dlon/2) 
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a)) 
-    d = R * c
-    return d
-    
-def cartesian(point):
-    lat = math.radians(point[0])
-    lon = math.radians(point[1])
-    R = 6371.0*1000 # m
-    h = R + point[2]
-    x = h * math.cos(lat) * math.cos(lon)
-    y = h * math.cos(lat) * math.sin(lon)
-    z = h * math.sin(lat)
-    return (x,y,z)
-
-def dotproduct(a,b):
-    return sum((a[0]*b[0],a[1]*b[1],a[2]*b[2]))
-    
-def delta(c1, c2, c3):
-    (x1,y1,z1) = c1
-    (x2,y2,z2) = c2
-    (x3,y3,z3) = c3
-    u = ((x2-x1),(y2-y1),(z2-z1))
-    v = ((x3-x2),(y3-y2),(z3-z2))
-    uv = dotproduct(u,v)
-    lu = math.sqrt(dotproduct(u,u))
-    lv = math.sqrt(dotproduct(v,v))
+        results = imap(_export_worker, works)
+    failed = []
+    for (count, (tp, error)) in enumerate(results):
+        if error:
+            failed.append(int(tp['id'])+1)
+            log.error('Track %d: %s' % (int(tp['id'])+1, error))
+        log.info('Exported %d/%d tracks' % (count+1, len(works)))
+    if pool:
+        pool.close()
+        pool.join()
+    if failed:
+        raise AssertionError('%d tracks failed to export: %s' % \
+                             (len(failed),
+                              ', '.join([str(it) for it in sorted(failed)])))
+
+def sync_device(log, cache, device, tpcat):
+    """Load all the tracks of the catalog that are not cached yet"""
+    reload_cache = False
+    for tp in tpcat:
+        if None in (tp['altmin'], tp['altmax']):
+            log.info('Should load sync track %d from device' % \
+                     (int(tp['id'])+1))
+            cache.load_trackpoints(device, tp['track'])
+            reload_cache = True
+    if reload_cache:
+        tpcat = cache.get_trackpoint_catalog(device)
+    return tpcat
+
+def find_ports(port):
+    """Expand the port option into a list of serial port names"""
+    if port == 'auto':
+        from keymaze import KeymazePort
+        ports = KeymazePort.discover()
+        if not ports:
+            raise AssertionError('No serial port found')
+        return ports
+    return port.split(',')
+
+def _sync_port(log, storage, port, lock, errors, reports):
+    from keymaze import KeymazePort
+    keymaze = None
     try:
-        theta = math.degrees(math.acos(uv/(lu*lv)))
-    except ZeroDivisionError:
-        theta = 0
-    return (lu, theta, lv)
-
-def optimize(points, angle=0):
-    tpoints = [(tp[0]/1000000.0, tp[1]/1000000.0, tp[2], tp[3], tp[4], tp[5]) \
-        for tp in points]
-    if angle == 0:
-        return tpoints
-    queue = [tpoints[0], tpoints[0]]
-    opt = list(queue)
-    for tp in tpoints:
-        # d = haversine(last[1], tp)
-        da = delta(cartesian(queue[0]), cartesian(queue[1]), cartesian(tp))
-        queue.pop(0)
-        queue.append(tp)
-        #print da
-        if da[1] > angle:
-            opt.append(tp)
-    return opt
+        keymaze = KeymazePort(log, port, verbose=False)
+        cache = KeymazeCache(log, storage, keymaze, lock)
+        info = cache.get_information()
+        log.info('%s: device %s' % (port, info['serialnumber']))
+        device = cache.get_device(info['serialnumber'])
+        tpcat = cache.get_trackpoint_catalog(device)
+        sync_device(log, cache, device, tpcat)
+        log.info('%s: synchronized' % port)
+    except AssertionError, e:
+        errors[port] = e[0]
+    except Exception, e:
+        # do not let a thread die silently
+        errors[port] = 'Unexpected error: %s' % e
+    finally:
+        if keymaze:
+            reports[port] = keymaze.stats.report()
+            keymaze.close()
+
+def sync_ports(log, storage, ports, reports):
+    """Synchronize the devices attached to several serial ports at once.
+
+       Each device is driven from its own thread, with its own connection to
+       the cache, and the cache writes are serialized with a shared lock.
+       The link statistics of each port are stored into reports.
+    """
+    lock = threading.RLock()
+    # create or upgrade the cache before it is used from several threads
+    KeymazeCache(log, storage, lock=lock)
+    errors = {}
+    threads = []
+    for port in ports:
+        thread = threading.Thread(target=_sync_port, name=port,
+                                  args=(log, storage, port, lock, errors,
+                                        reports))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    for port in ports:
+        if port in errors:
+            log.error('%s: %s' % (port, errors[port]))
+    if errors:
+        raise AssertionError('%d devices failed to synchronize' % \
+                             len(errors))
+
+def write_link_report(path, reports):
+    """Write the link statistics of the device sessions as a JSON report,
+       indexed on serial port names"""
+    import json
+    out = path == '-' and sys.stdout or open(path, 'wt')
+    try:
+        json.dump(reports, out, indent=2, sort_keys=True)
+        out.write('\n')
+    finally:
+        if out != sys.stdout:
+            out.close()
+
+def check_numpy(options):
+    """Fail early if the selected options require NumPy, which is only an
+       optional dependency"""
+    used = [opt for (opt, value) in (('-O', options.simplify),
+                                     ('-a', options.analytics),
+                                     ('-L', options.lod)) if value]
+    if not used:
+        return
+    try:
+        import numpy
+    except ImportError:
+        raise AssertionError('NumPy is required by the %s option%s' % \
+                             (', '.join(used), len(used) > 1 and 's' or ''))
+
+def optimize(points, mode=None, tolerance=None):
+    """Simplify a track, if a simplification mode is selected"""
+    if not mode or len(points) < 3:
+        return points
+    from simplify import simplify
+    keep = simplify(points.degrees('lat'), points.degrees('lon'),
+                    points.numpy('alt'), mode, tolerance)
+    return points.take(keep)
 
 
 if __name__ == '__main__':
@@ -160,26 +502,65 @@ if __name__ == '__main__':
     else:
         dbpath = os.path.join(dbpath, '.pykmaze', dbname)
     modes = ('default', 'air')
+    simplify_modes = ('angle', 'dp', 'vw')
+    gpx_versions = ('1.0', '1.1')
     usage = 'Usage: %prog [options]\n' \
             '   Keymaze 500-700 communicator'
     optparser = OptionParser(usage=usage)
     optparser.add_option('-p', '--port', dest='port',
                          default='/dev/cu.usbserial',
-                         help='Serial port name')
+                         help='Serial port name, comma-separated port names '
+                              'or "auto" to synchronize several devices')
+    optparser.add_option('--capture', dest='capture',
+                         help='Record the device traffic to a trace file')
+    optparser.add_option('--replay', dest='replay',
+                         help='Replay a trace file rather than communicating '
+                              'with a device')
+    optparser.add_option('--realtime', dest='realtime', action='store_true',
+                         help='Replay a trace file with its original timing')
+    optparser.add_option('--link-report', dest='link_report',
+                         help='Write the link statistics to a JSON file, '
+                              'or - for the standard output')
+    optparser.add_option('-n', '--serial', dest='serial',
+                         help='Serial number of the cached device to use '
+                              'in offline mode')
     optparser.add_option('-k', '--kml', dest='kml',
                          help='Export to KML, output file name')
     optparser.add_option('-K', '--kmz', dest='kmz',
                          help='Export to KMZ, output file name')
     optparser.add_option('-x', '--gpx', dest='gpx',
                          help='Export to GPX, output file name')
+    optparser.add_option('--gpx-version', dest='gpx_version',
+                         choices=gpx_versions, default=gpx_versions[0],
+                         help='GPX format version among [%s]' % \
+                              ','.join(gpx_versions))
+    optparser.add_option('-L', '--lod', dest='lod', action='store_true',
+                         help='Compute the levels of detail of the cached '
+                              'tracks that lack them, and export KMZ files '
+                              'as tiles that are loaded as the view zooms '
+                              'in')
     optparser.add_option('-T', '--trim', dest='trim',
-                         help='Trim a track start[,end] with [+-]hh:mm:ss')
+                         help='Trim a track start[,end] with [+-]hh:mm:ss '
+                              'relative times, or hh:mm:ss or '
+                              'YYYY-MM-DDThh:mm:ss absolute times')
+    optparser.add_option('-O', '--simplify', dest='simplify',
+                         choices=simplify_modes,
+                         help='Simplify exported tracks with a mode among '
+                              '[%s]' % ','.join(simplify_modes))
+    optparser.add_option('-e', '--tolerance', dest='tolerance', type='float',
+                         help='Simplification tolerance, in degrees for '
+                              'angle mode, in meters otherwise')
     optparser.add_option('-z', '--zoffset', dest='zoffset', default='0',
                          help='Offset to add on z-axis (meters)')
     optparser.add_option('-s', '--storage', dest='storage', 
                          default=dbpath,
                          help='Specify path for data storage (default: %s)' \
                                 % dbpath)
+    optparser.add_option('-C', '--convert', dest='convert',
+                         choices=KeymazeCache.LAYOUTS,
+                         help='Convert the cached trackpoints to a storage '
+                              'layout among [%s]' % \
+                              ','.join(KeymazeCache.LAYOUTS))
     optparser.add_option('-o', '--offline', dest='offline', 
                          action='store_true',
                          help='Offline (used cached information)')
@@ -196,7 +577,38 @@ if __name__ == '__main__':
                          action='store_true',
                          help='Show track catalog')
     optparser.add_option('-t', '--track', dest='track', 
-                         help='Retrieve trackpoint for specified track')
+                         help='Retrieve trackpoint for specified track, or '
+                              'all tracks. When several tracks are exported, '
+                              'a -DATE suffix is appended to the output file '
+                              'names, unless they contain %(id)d, %(track)d '
+                              'or %(date)s fields')
+    optparser.add_option('-d', '--dates', dest='dates',
+                         help='Select the tracks recorded within a '
+                              'YYYY-MM-DD[,YYYY-MM-DD] date range')
+    optparser.add_option('-r', '--report', dest='report',
+                         choices=KeymazeCache.PERIODS,
+                         help='Show the activity totals per period among '
+                              '[%s]' % ','.join(KeymazeCache.PERIODS))
+    optparser.add_option('-a', '--analytics', dest='analytics',
+                         action='store_true',
+                         help='Show the distance, climb, splits and heart '
+                              'rate zones of the selected tracks')
+    optparser.add_option('-b', '--bbox', dest='bbox',
+                         help='Show the cached tracks that cross a '
+                              'minlat,minlon,maxlat,maxlon box (degrees), and '
+                              'restrict the track selection to them')
+    optparser.add_option('-N', '--near', dest='near',
+                         help='Show the cached tracks that pass near a '
+                              'lat,lon[,radius] position (degrees, meters), '
+                              'and restrict the track selection to them')
+    optparser.add_option('--export-cache', dest='export_cache', type='float',
+                         default=64,
+                         help='Size of the cache of the rendered export '
+                              'files, in megabytes, or 0 to disable it '
+                              '(default: 64)')
+    optparser.add_option('-j', '--jobs', dest='jobs', type='int',
+                         help='Count of parallel jobs to export several '
+                              'tracks (default: count of CPUs)')
     optparser.add_option('-m', '--mode', dest='mode', choices=modes,
                          help='Use show mode among [%s]' % ','.join(modes),
                          default=modes[0])
@@ -211,18 +623,46 @@ if __name__ == '__main__':
     ch.setFormatter(formatter)
     log.addHandler(ch)
     
+    keymaze = None
+    reports = {}
     try:
+        check_numpy(options)
         if options.force and options.offline:
             raise AssertionError('Force and offline modes are mutually '
                                  'exclusive')
-        keymaze = None
-        if not options.offline:
-            keymaze = KeymazePort(log, options.port)
-        elif options.sync:
-            raise AssertionError('Cannot sync from device in offline mode')
+        if options.offline and options.replay:
+            raise AssertionError('Replay and offline modes are mutually '
+                                 'exclusive')
+        if options.offline:
+            if options.sync:
+                raise AssertionError('Cannot sync from device in offline '
+                                     'mode')
+        elif options.replay:
+            from capture import ReplayTransport
+            from keymaze import KeymazePort
+            keymaze = KeymazePort(log, options.replay,
+                                  transport=ReplayTransport(options.replay,
+                                                            options.realtime),
+                                  capture=options.capture)
+        else:
+            ports = find_ports(options.port)
+            if len(ports) > 1:
+                if not options.sync:
+                    raise AssertionError('Several devices can only be '
+                                         'synchronized')
+                if options.capture:
+                    raise AssertionError('Cannot capture several devices')
+                sync_ports(log, options.storage, ports, reports)
+                options.sync = False
+            else:
+                from keymaze import KeymazePort
+                keymaze = KeymazePort(log, ports[0], capture=options.capture)
         cache = KeymazeCache(log, options.storage, keymaze)
 
-        info = cache.get_information()
+        if options.convert:
+            cache.convert(options.convert)
+
+        info = cache.get_information(options.serial)
 
         if options.info:
             print ' Device: %s' % info['name']
@@ -235,85 +675,71 @@ if __name__ == '__main__':
         tpcat = cache.get_trackpoint_catalog(device)
         
         if options.sync:
-            reload_cache = False
-            for tp in tpcat:
-                if None in (tp['altmin'], tp['altmax']):
-                    log.info('Should load sync track %d from device' % \
-                             (int(tp['id'])+1))
-                    cache.get_trackpoints(device, tp['track'])
-                    reload_cache = True
-            if reload_cache:
-                tpcat = cache.get_trackpoint_catalog(device)
+            tpcat = sync_device(log, cache, device, tpcat)
                     
         if options.catalog:
             show_trackpoints_catalog(tpcat)
             print ''
         
+        if options.report:
+            show_rollups(options.report,
+                         cache.get_rollups(device, options.report))
+            print ''
+
+        if options.lod:
+            log.info('Levels of detail computed for %d tracks' % \
+                     cache.build_lod(device))
+
+        if options.bbox or options.near:
+            area = parse_area(options.bbox, options.near)
+            matches = find_area_tracks(cache, device, area)
+            show_area_tracks(tpcat, matches)
+            print ''
+            tpcat = [tp for tp in tpcat if tp['track'] in matches]
+
+        if options.dates and not options.track:
+            options.track = 'all'
+
         if options.track:
-            tracks = []
-            if options.track in ['all']:
-                if options.kml or options.kmz or options.gpx:
-                    raise AssertionError('Cannot export several tracks')
-                tracks = [tp['track'] for tp in tpcat]
-                log.debug('Tracks %s' % tracks)
-            else:
-                for tp in tpcat:
-                    track = int(options.track)-1
-                    if int(tp['id']) == track: 
-                        tracks = [tp['track']]
-                        break
-                if not tracks:
-                    raise AssertionError('Track "%s" does not exist' % \
-                                         options.track)
-            tpoints = []
-            for track in tracks:
-                log.info('Recovering trackpoints for track %u' % track)
-                tpoints = cache.get_trackpoints(device, track)
-            if len(tracks) == 1:
-                km = options.kml or options.kmz
-                if km:
-                    from kml import KmlDoc
-                if options.gpx:
-                    from gpx import GpxDoc
-                    
-                if km or options.gpx:
-                    track_info = filter(lambda x: x['track'] == track, 
-                                        tpcat)[0]
-                    if options.trim:
-                        trims = parse_trim(options.trim.split(','))
-                        log.info('All points: %d' % len(tpoints))
-                        tpoints = trim_trackpoints(track_info, tpoints, trims)
-                        log.info('Filtered points: %d' % len(tpoints))
-                    optpoints = optimize(tpoints, 0)
-                    log.info('Count: %u, opt: %u', 
-                              len(tpoints), len(optpoints))
-                if km:
-                    kml = KmlDoc(os.path.splitext(os.path.basename(km))[0])
-                    kml.add_trackpoints(optpoints, int(options.zoffset), 
-                                        extrude='air' not in options.mode)
-                if options.kmz:
-                    import zipfile
-                    import cStringIO as StringIO
-                    out = StringIO.StringIO()
-                    kml.write(out)
-                    out.write('\n')
-                    z = zipfile.ZipFile(options.kmz, 'w', 
-                                        zipfile.ZIP_DEFLATED)
-                    z.writestr('doc.kml', out.getvalue())
-                if options.kml:
-                    with open(options.kml, 'wt') as out:
-                        kml.write(out)
-                        out.write('\n')
-                
-                if options.gpx:
-                    gpx = GpxDoc(os.path.splitext( \
-                                 os.path.basename(options.gpx))[0],
-                                 track_info['start'])
-                    gpx.add_trackpoints(optpoints, int(options.zoffset))
-                    with open(options.gpx, 'wt') as out:
-                        gpx.write(out)
-                        out.write('\n')
+            tracks = select_tracks(tpcat, options.track, options.dates)
+            log.debug('Tracks %s' % [tp['track'] for tp in tracks])
+            for tp in tracks:
+                log.info('Recovering trackpoints for track %u' % tp['track'])
+                cache.load_trackpoints(device, tp['track'])
+            if options.analytics:
+                # estimated maximum heart rate of the device owner
+                maxheart = 220-(info['age'] or 30)
+                for tp in tracks:
+                    show_analytics(tp, cache.get_analytics(device,
+                                                           tp['track'],
+                                                           maxheart))
+            outputs = {}
+            for fmt in ('kml', 'kmz', 'gpx'):
+                if getattr(options, fmt):
+                    outputs[fmt] = getattr(options, fmt)
+            settings = { 'trim' : options.trim,
+                         'simplify' : options.simplify,
+                         'tolerance' : options.tolerance,
+                         'lod' : options.lod,
+                         'exports' : None,
+                         'zoffset' : int(options.zoffset),
+                         'extrude' : 'air' not in options.mode,
+                         'gpx_version' : options.gpx_version }
+            if options.export_cache > 0:
+                settings['exports'] = \
+                    ('%s-exports' % os.path.splitext(options.storage)[0],
+                     int(options.export_cache*1024*1024))
+            if outputs and len(tracks) == 1:
+                export_track(cache, device, tracks[0], outputs, settings)
+            elif outputs:
+                batch_export(log, options.storage, device, tracks, outputs,
+                             settings, options.jobs)
                         
     except AssertionError, e:
         print >> sys.stderr, 'Error: %s' % e[0]
-
+    finally:
+        if keymaze:
+            reports[keymaze.portname] = keymaze.stats.report()
+            keymaze.close()
+        if options.link_report and reports:
+            write_link_report(options.link_report, reports)
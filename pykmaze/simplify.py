@@ -0,0 +1,148 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from array import array
+import numpy
+
+EARTH_RADIUS = 6371.0*1000 # m
+
+# Simplification modes, and their default tolerance:
+#  angle: drop points where the track direction changes by less than the
+#         tolerance (degrees)
+#  dp:    Douglas-Peucker, drop points closer than the tolerance (meters) to
+#         the simplified track
+#  vw:    Visvalingam-Whyatt, drop points whose effective area is smaller
+#         than the tolerance squared (square meters)
+MODES = { 'angle' : 5.0,
+          'dp' : 5.0,
+          'vw' : 5.0 }
+
+
+def simplify(lat, lon, alt, mode, tolerance=None):
+    """Simplify a track, whose position are given in degrees and altitude
+       in meters. Return the sorted array of the indices of the points to
+       keep; the first and last points are always kept.
+    """
+    if mode not in MODES:
+        raise AssertionError('Unsupported simplification mode "%s"' % mode)
+    if tolerance is None:
+        tolerance = MODES[mode]
+    lat = _column(lat)
+    lon = _column(lon)
+    if len(lat) < 3:
+        return numpy.arange(len(lat))
+    if mode == 'angle':
+        return _simplify_angle(cartesian(lat, lon, _column(alt)), tolerance)
+    xy = project(lat, lon)
+    if mode == 'dp':
+        return _simplify_dp(xy, tolerance)
+    return _simplify_vw(xy, tolerance*tolerance)
+
+def cartesian(lat, lon, alt):
+    """Convert geographic coordinates into an (n,3) array of earth-centered
+       coordinates, in meters"""
+    lat = numpy.radians(lat)
+    lon = numpy.radians(lon)
+    h = EARTH_RADIUS + alt
+    xyz = numpy.empty((len(lat), 3))
+    xyz[:,0] = h * numpy.cos(lat) * numpy.cos(lon)
+    xyz[:,1] = h * numpy.cos(lat) * numpy.sin(lon)
+    xyz[:,2] = h * numpy.sin(lat)
+    return xyz
+
+def project(lat, lon):
+    """Project geographic coordinates onto an (n,2) array of planar
+       coordinates, in meters, using an equirectangular projection centered
+       on the track"""
+    lat = numpy.radians(lat)
+    lon = numpy.radians(lon)
+    xy = numpy.empty((len(lat), 2))
+    xy[:,0] = EARTH_RADIUS * lon * numpy.cos(lat.mean())
+    xy[:,1] = EARTH_RADIUS * lat
+    return xy
+
+def _column(values):
+    if isinstance(values, array):
+        # share the array storage
+        values = numpy.frombuffer(values, dtype=numpy.dtype(values.typecode))
+    return numpy.asarray(values, dtype=float)
+
+def _simplify_angle(xyz, angle):
+    u = numpy.diff(xyz, axis=0)
+    length = numpy.sqrt((u*u).sum(axis=1))
+    norm = length[:-1]*length[1:]
+    dot = (u[:-1]*u[1:]).sum(axis=1)
+    cos = numpy.ones(len(dot))
+    valid = norm > 0
+    cos[valid] = numpy.clip(dot[valid]/norm[valid], -1.0, 1.0)
+    theta = numpy.degrees(numpy.arccos(cos))
+    keep = numpy.empty(len(xyz), dtype=bool)
+    keep[0] = keep[-1] = True
+    keep[1:-1] = theta > angle
+    return numpy.flatnonzero(keep)
+
+def _simplify_dp(xy, tolerance):
+    keep = numpy.zeros(len(xy), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xy)-1)]
+    while stack:
+        (first, last) = stack.pop()
+        if last-first < 2:
+            continue
+        start = xy[first]
+        seg = xy[last]-start
+        pts = xy[first+1:last]-start
+        seglen = numpy.dot(seg, seg)
+        if seglen > 0:
+            # distance to the segment, clamped at both ends
+            t = numpy.clip(numpy.dot(pts, seg)/seglen, 0.0, 1.0)
+            dist = pts-numpy.outer(t, seg)
+        else:
+            dist = pts
+        dist = (dist*dist).sum(axis=1)
+        pos = int(dist.argmax())
+        if dist[pos] > tolerance*tolerance:
+            split = first+1+pos
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return numpy.flatnonzero(keep)
+
+def _simplify_vw(xy, area):
+    # Points are removed by batches: on each pass, every point whose
+    # triangle area is below the threshold and is a local minimum is
+    # discarded, which never removes two neighbouring points at once.
+    # Neighbouring local minima share the same area, as on a stationary
+    # stretch: every other one is discarded, so that such a run is halved
+    # on each pass.
+    idx = numpy.arange(len(xy))
+    while len(idx) > 2:
+        a = xy[idx[:-2]]
+        b = xy[idx[1:-1]]
+        c = xy[idx[2:]]
+        areas = 0.5*numpy.abs((b[:,0]-a[:,0])*(c[:,1]-a[:,1]) -
+                              (c[:,0]-a[:,0])*(b[:,1]-a[:,1]))
+        small = areas < area
+        if not small.any():
+            break
+        left = numpy.empty_like(areas)
+        left[0] = numpy.inf
+        left[1:] = areas[:-1]
+        right = numpy.empty_like(areas)
+        right[-1] = numpy.inf
+        right[:-1] = areas[1:]
+        drop = small & (areas <= left) & (areas <= right)
+        # rank of each point within its run of neighbouring minima
+        starts = drop.copy()
+        starts[1:] &= ~drop[:-1]
+        first = numpy.flatnonzero(starts)
+        rank = numpy.arange(len(drop))-first[numpy.cumsum(starts)-1]
+        drop &= rank % 2 == 0
+        keep = numpy.ones(len(idx), dtype=bool)
+        keep[1:-1] = ~drop
+        idx = idx[keep]
+    return idx
@@ -0,0 +1,195 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from frame import xor_checksum
+from keymaze import KeymazePort
+import datetime
+import math
+import os
+import random
+import select
+import struct
+import threading
+import time
+import tty
+
+
+class KeymazeSimulator(object):
+    """Simulated Keymaze device, served on a pseudo-terminal
+
+       The device answers the requests KeymazePort emits, so that a
+       KeymazePort instance opened on the simulator port name may be used
+       without any hardware. The link may be degraded on purpose:
+
+       baudrate: throttle the responses to the specified link speed
+       latency: delay before each response, in seconds
+       noise: probability for each response byte to be corrupted
+       drop: probability for each response byte to be lost
+
+       serialnumber tells simulated devices apart.
+    """
+
+    # count of trackpoints sent in each CMD_TP_GET_NEXT response
+    CHUNK = 60
+
+    def __init__(self, tracks, baudrate=None, latency=0.0, noise=0.0,
+                 drop=0.0, seed=None, serialnumber='SIM00000001'):
+        self.tracks = tracks
+        self.serialnumber = serialnumber
+        self.baudrate = baudrate
+        self.latency = latency
+        self.noise = noise
+        self.drop = drop
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._cursor = None
+        self._stop = threading.Event()
+        (self._master, self._slave) = os.openpty()
+        tty.setraw(self._slave)
+        self.portname = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._serve,
+                                        name='KeymazeSimulator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._slave)
+        os.close(self._master)
+
+    @staticmethod
+    def make_track(track, count, start=None):
+        """Build a synthetic track with count trackpoints"""
+        rnd = random.Random(track)
+        (lat, lon, heading) = (45000000.0, 5000000.0, 0.0)
+        points = []
+        for pos in xrange(count):
+            heading += rnd.gauss(0, 0.1)
+            lat += 20*math.cos(heading)
+            lon += 20*math.sin(heading)
+            points.append((int(lat), int(lon),
+                           200+int(50*math.sin(pos/100.0)),
+                           int(100+10*math.sin(pos/10.0)),
+                           rnd.randint(100, 180), 10))
+        alts = [p[2] for p in points]
+        return { 'track' : track,
+                 'start' : start or datetime.datetime(2010, 1, 1, 10, 0, 0)+
+                              datetime.timedelta(track),
+                 'distance' : count*5,
+                 'climb' : sum([max(0, b-a) for (a, b) in zip(alts,
+                                                             alts[1:])]),
+                 'points' : points }
+
+    def _serve(self):
+        buf = ''
+        while not self._stop.isSet():
+            (rlist, wlist, xlist) = select.select([self._master], [], [], 0.1)
+            if not rlist:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while True:
+                # look for a complete request
+                start = buf.find(chr(KeymazePort.CMD_PREFIX))
+                if start < 0:
+                    buf = ''
+                    break
+                buf = buf[start:]
+                if len(buf) < 3:
+                    break
+                (length,) = struct.unpack('>H', buf[1:3])
+                if len(buf) < 4+length:
+                    break
+                (request, buf) = (buf[:4+length], buf[4+length:])
+                if xor_checksum(request[1:-1]) != ord(request[-1]):
+                    continue
+                self.requests += 1
+                (command, payload) = self._respond(ord(request[3]),
+                                                   request[4:-1])
+                self._send(command, payload)
+
+    def _respond(self, command, params):
+        if command == KeymazePort.CMD_INFO_GET:
+            return (command, self._info())
+        if command == KeymazePort.CMD_TP_DIR:
+            return (command, ''.join([self._entry(idx, track) for \
+                                         (idx, track) in \
+                                         enumerate(self.tracks)]))
+        if command == KeymazePort.CMD_TP_GET_HDR:
+            (count, track) = struct.unpack('>HH', params[:4])
+            for (idx, tp) in enumerate(self.tracks):
+                if tp['track'] == track:
+                    self._cursor = (idx, 0)
+                    return (command, self._entry(idx, tp) + \
+                                struct.pack('>%s' % KeymazePort.TP_HDR_FMT,
+                                            0, 0, 0, 0, 0, 0, 0,
+                                            len(tp['points'])))
+            return (KeymazePort.ACK_TP_GET_NONE, '')
+        if command == KeymazePort.CMD_TP_GET_NEXT:
+            if not self._cursor:
+                return (KeymazePort.ACK_TP_GET_NONE, '')
+            (idx, pos) = self._cursor
+            tp = self.tracks[idx]
+            points = tp['points'][pos:pos+self.CHUNK]
+            if not points:
+                self._cursor = None
+                return (KeymazePort.ACK_TP_GET_NONE, '')
+            self._cursor = (idx, pos+len(points))
+            return (command, self._entry(idx, tp) + \
+                        ''.join([KeymazePort.TP_ENT.pack(*p) for p in points]))
+        return (KeymazePort.ACK_TP_GET_NONE, '')
+
+    def _info(self):
+        return KeymazePort.INFO.pack('KEYMAZE SIM', self.serialnumber,
+                                     'Tester', 0, 30, 0, 70, 0, 175, 190, 0, 1)
+
+    def _entry(self, idx, tp):
+        start = tp['start']
+        dtime = sum([p[5] for p in tp['points']])
+        return KeymazePort.TP_CAT.pack(start.year-2000, start.month,
+                                       start.day, start.hour, start.minute,
+                                       start.second, 1, dtime,
+                                       tp['distance'], 0, 0, 0, 0,
+                                       tp.get('climb', 0), 0, 0,
+                                       tp['track'], idx)
+
+    def _send(self, command, payload):
+        frame = struct.pack('>BH', command, len(payload)) + payload
+        frame += chr(xor_checksum(frame[1:]))
+        if self.noise or self.drop:
+            frame = self._degrade(frame)
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.baudrate:
+            os.write(self._master, frame)
+            return
+        # pace the output to the link speed, in small slices
+        slice_size = max(1, self.baudrate//(10*100))
+        byte_time = 10.0/self.baudrate
+        start = time.time()
+        for pos in xrange(0, len(frame), slice_size):
+            os.write(self._master, frame[pos:pos+slice_size])
+            delay = start+(pos+slice_size)*byte_time-time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _degrade(self, frame):
+        out = []
+        rnd = self._random
+        for byte in frame:
+            if rnd.random() < self.drop:
+                continue
+            if rnd.random() < self.noise:
+                byte = chr(ord(byte) ^ (1 << rnd.randint(0, 7)))
+            out.append(byte)
+        return ''.join(out)
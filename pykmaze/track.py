@@ -0,0 +1,131 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from array import array
+from itertools import izip
+
+
+class Track(object):
+    """Trackpoints of an activity, stored as one array('i') column per
+       value, in device units: latitude and longitude in millionths of
+       degree, altitude in meters, time delta in tenths of second.
+
+       Slicing a track returns a view that shares the columns of the
+       original track. Indexing and iterating yield per-point tuples, in
+       FIELDS order.
+    """
+
+    __slots__ = ('_columns', '_start', '_stop')
+
+    FIELDS = ('lat', 'lon', 'alt', 'speed', 'heart', 'delta')
+
+    # scale of the position columns
+    DEGREE = 1000000.0
+
+    def __init__(self, columns=None, start=0, stop=None):
+        if columns is None:
+            columns = tuple([array('i') for field in self.FIELDS])
+        if len(columns) != len(self.FIELDS):
+            raise AssertionError('Invalid track columns')
+        self._columns = tuple(columns)
+        self._start = start
+        if stop is None:
+            stop = len(self._columns[0])
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop-self._start
+
+    def __iter__(self):
+        return izip(*[self.column(field) for field in self.FIELDS])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            (start, stop, step) = index.indices(len(self))
+            if step != 1:
+                raise AssertionError('Unsupported track slice step')
+            return Track(self._columns, self._start+start,
+                         self._start+max(start, stop))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Trackpoint index out of range')
+        return tuple([column[self._start+index] for column in self._columns])
+
+    def __eq__(self, other):
+        return len(self) == len(other) and \
+            all([a == b for (a, b) in izip(self, other)])
+
+    def __ne__(self, other):
+        return not self == other
+
+    def is_view(self):
+        """Tell whether the track only covers part of its columns"""
+        return self._start != 0 or self._stop != len(self._columns[0])
+
+    def column(self, field):
+        """Values of a field, as an array. The array is only shared with the
+           track if the track is not a view, otherwise the values of the
+           view are copied (see numpy for a view that shares the storage)"""
+        column = self._columns[self.FIELDS.index(field)]
+        if self.is_view():
+            return column[self._start:self._stop]
+        return column
+
+    def columns(self):
+        return tuple([self.column(field) for field in self.FIELDS])
+
+    def numpy(self, field):
+        """Values of a field, as a NumPy array sharing the track storage"""
+        import numpy
+        column = self._columns[self.FIELDS.index(field)]
+        return numpy.frombuffer(column, dtype=numpy.dtype(column.typecode),
+                                count=len(self),
+                                offset=self._start*column.itemsize)
+
+    def degrees(self, field):
+        """Latitudes or longitudes, converted to degrees"""
+        scale = self.DEGREE
+        return array('d', [value/scale for value in self.column(field)])
+
+    def extend(self, points):
+        """Append trackpoint tuples"""
+        if self.is_view():
+            raise AssertionError('Cannot extend a track view')
+        for (column, values) in izip(self._columns, izip(*points)):
+            column.extend(values)
+        self._stop = len(self._columns[0])
+
+    def take(self, indices):
+        """Build a new track from the points at the specified sorted
+           indices. The time deltas of the points that are left out are
+           carried over to the next kept point, so that timestamps remain
+           accurate. The columns are read in place, and each time delta is
+           only summed up once, so the cost is bound to the span of the
+           indices"""
+        track = Track()
+        base = self._start
+        positions = [base+int(pos) for pos in indices]
+        for (column, source) in izip(track._columns[:-1], self._columns[:-1]):
+            column.extend([source[pos] for pos in positions])
+        deltas = track._columns[-1]
+        source = self._columns[-1]
+        last = base
+        for pos in positions:
+            deltas.append(sum(source[last:pos+1]))
+            last = pos+1
+        track._stop = len(deltas)
+        return track
+
+    def bounds(self):
+        """Compute the bounds of the track, in degrees"""
+        (lat, lon) = (self.column('lat'), self.column('lon'))
+        scale = self.DEGREE
+        return { 'minlat' : min(lat)/scale,
+                 'minlon' : min(lon)/scale,
+                 'maxlat' : max(lat)/scale,
+                 'maxlon' : max(lon)/scale }
@@ -0,0 +1,102 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import errno
+import os
+import select
+import time
+
+
+class SerialTransport(object):
+    """Byte stream over a serial port.
+
+       When the port exposes a file descriptor, reception waits on the
+       descriptor and reads every available byte at once, rather than
+       polling the port. Other ports (such as pyftdi ones) are accessed
+       through their regular blocking API.
+    """
+
+    # bytes read at once from the file descriptor
+    READ_SIZE = 4096
+
+    # silence, in byte transmission times, after which the line is
+    # considered idle when draining it
+    QUIET_BYTES = 32
+
+    def __init__(self, port, baudrate):
+        self._port = port
+        # start, 8 data and stop bits
+        self.byte_time = 10.0/baudrate
+        try:
+            self._fd = port.fileno()
+        except (AttributeError, NotImplementedError, ValueError):
+            self._fd = None
+
+    def write(self, data):
+        self._port.write(data)
+
+    def recv(self, size, timeout):
+        """Receive the bytes that are available, up to size bytes, waiting
+           up to timeout seconds for the first one"""
+        if self._fd is None:
+            self._port.timeout = timeout
+            try:
+                rem = self._port.inWaiting()
+            except IOError:
+                rem = 0
+            return self._port.read(max(1, min(rem, size)))
+        deadline = time.time()+timeout
+        while True:
+            remaining = deadline-time.time()
+            if remaining <= 0 or not self._wait(remaining):
+                return ''
+            data = self._read_fd(size)
+            if data is not None:
+                return data
+
+    def drain(self, wait=True):
+        """Discard all received bytes, until the line becomes idle, or only
+           the already received ones if wait is not set"""
+        quiet = wait and self.QUIET_BYTES*self.byte_time or 0
+        if self._fd is None:
+            while True:
+                if quiet:
+                    time.sleep(quiet)
+                try:
+                    rem = self._port.inWaiting()
+                except IOError:
+                    rem = 0
+                if not rem:
+                    break
+                self._port.read(rem)
+            return
+        while self._wait(quiet):
+            if self._read_fd(self.READ_SIZE) == '':
+                break
+
+    def close(self):
+        if self._port.isOpen():
+            self._port.close()
+
+    def _wait(self, timeout):
+        while True:
+            try:
+                (rlist, wlist, xlist) = select.select([self._fd], [], [],
+                                                      timeout)
+                return bool(rlist)
+            except select.error, e:
+                if e[0] != errno.EINTR:
+                    raise
+
+    def _read_fd(self, size):
+        """Read available bytes, or None if there is none"""
+        try:
+            return os.read(self._fd, min(size, self.READ_SIZE))
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            raise
@@ -38,7 +38,9 @@ setup(
     url='http://github.com/eblot/pykmaze',
     download_url='https://github.com/eblot/pykmaze/tarball/master',
     packages=['pykmaze'],
-    requires=['serial (>= 2.5)'],
+    # NumPy is only needed by the track simplification (-O), analytics (-a)
+    # and level of detail (-L) options
+    requires=['serial (>= 2.5)', 'numpy (>= 1.3)'],
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Console',
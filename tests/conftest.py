@@ -0,0 +1,58 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import datetime
+import logging
+import os
+import sys
+
+import pytest
+
+# the pykmaze modules import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'pykmaze'))
+
+
+def make_track(track, count, days=0):
+    """Build a synthetic simulator track"""
+    from simulator import KeymazeSimulator
+    return KeymazeSimulator.make_track(track, count,
+                                       datetime.datetime(2010, 1, 1, 9)+ \
+                                           datetime.timedelta(days))
+
+
+@pytest.fixture
+def log():
+    return logging.getLogger('pykmaze.tests')
+
+
+@pytest.fixture
+def simulator():
+    """Factory of simulated devices, closed at the end of the test"""
+    from simulator import KeymazeSimulator
+    devices = []
+    def factory(tracks, **kwargs):
+        device = KeymazeSimulator(tracks, **kwargs)
+        devices.append(device)
+        return device
+    yield factory
+    for device in devices:
+        device.close()
+
+
+@pytest.fixture
+def open_port(log):
+    """Factory of device ports, closed at the end of the test"""
+    from keymaze import KeymazePort
+    ports = []
+    def factory(sim):
+        port = KeymazePort(log, sim.portname, verbose=False)
+        ports.append(port)
+        return port
+    yield factory
+    for port in ports:
+        port.close()
@@ -0,0 +1,80 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import time
+
+import pytest
+
+from capture import ReplayTransport
+from conftest import make_track
+from keymaze import KeymazePort
+
+# delay of the first trackpoint response of the captured device
+DELAY = 0.5
+
+
+def download(port, track=0):
+    info = port.get_information()
+    catalog = port.get_trackpoint_catalog()
+    return (info, catalog, port.get_trackpoints(track))
+
+
+@pytest.fixture
+def trace(log, simulator, tmpdir):
+    """Capture the download of a track from a simulated device, whose first
+       trackpoint response is late"""
+    sim = simulator([make_track(0, 300), make_track(1, 10, 1)])
+    send = sim._send
+    def late_send(command, payload):
+        if command == KeymazePort.CMD_TP_GET_HDR:
+            time.sleep(DELAY)
+        send(command, payload)
+    sim._send = late_send
+    path = str(tmpdir.join('download.trace'))
+    port = KeymazePort(log, sim.portname, verbose=False, capture=path)
+    try:
+        result = download(port)
+    finally:
+        port.close()
+    return (path, result)
+
+
+def replay(log, path, realtime=False):
+    return KeymazePort(log, 'replay', verbose=False,
+                       transport=ReplayTransport(path, realtime))
+
+
+def test_replay(log, trace):
+    (path, captured) = trace
+    port = replay(log, path)
+    start = time.time()
+    (info, catalog, tp) = download(port)
+    # responses are delivered at once
+    assert time.time()-start < DELAY
+    assert (info, catalog) == captured[:2]
+    assert list(tp['points']) == list(captured[2]['points'])
+    assert len(tp['points']) == 300
+
+
+def test_replay_realtime(log, trace):
+    (path, captured) = trace
+    port = replay(log, path, True)
+    start = time.time()
+    (info, catalog, tp) = download(port)
+    # responses are delivered with their recorded delay
+    assert time.time()-start >= DELAY
+    assert list(tp['points']) == list(captured[2]['points'])
+
+
+def test_replay_diverges(log, trace):
+    port = replay(log, trace[0])
+    port.get_information()
+    port.get_trackpoint_catalog()
+    # the captured session downloaded another track
+    with pytest.raises(AssertionError) as exc:
+        port.get_trackpoints(1)
+    assert 'Replay diverges' in str(exc.value)
@@ -0,0 +1,247 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import logging
+import time
+
+import pytest
+
+from conftest import make_track
+from db import KeymazeCache
+from simulator import KeymazeSimulator
+
+
+def interrupt(cache, device, track, chunk):
+    """Discard the end of a cached download, from the specified chunk, as
+       if the download had been interrupted"""
+    first = chunk*KeymazeSimulator.CHUNK
+    with cache._transaction():
+        cache._truncate_trackpoints(device, track, chunk, first)
+        cache.db.execute('DELETE FROM tp_summary WHERE device=? AND track=?',
+                         (device, track))
+
+
+@pytest.fixture
+def cache(log, tmpdir):
+    def factory(port):
+        return KeymazeCache(log, str(tmpdir.join('cache.sqlite')), port)
+    return factory
+
+
+def test_information(simulator, open_port, cache):
+    sim = simulator([make_track(0, 10)])
+    info = cache(open_port(sim)).get_information()
+    assert info['serialnumber'] == 'SIM00000001'
+    assert info['user'] == 'Tester'
+
+
+def test_same_catalog_devices(simulator, open_port, cache):
+    # two watches that hold the same tracks are still told apart
+    tracks = [make_track(0, 10)]
+    devices = []
+    for sn in ('SIM00000001', 'SIM00000002'):
+        kc = cache(open_port(simulator(tracks, serialnumber=sn)))
+        info = kc.get_information()
+        assert info['serialnumber'] == sn
+        device = kc.get_device(sn)
+        kc.get_trackpoint_catalog(device)
+        devices.append(device)
+        kc.db.close()
+    assert devices[0] != devices[1]
+
+
+@pytest.mark.parametrize('layout', KeymazeCache.LAYOUTS)
+def test_download(simulator, open_port, cache, layout):
+    tracks = [make_track(0, 1000), make_track(1, 7, 2), make_track(2, 0, 4)]
+    sim = simulator(tracks)
+    kc = cache(open_port(sim))
+    kc.convert(layout)
+    device = kc.get_device(kc.get_information()['serialnumber'])
+    catalog = kc.get_trackpoint_catalog(device)
+    assert [tp['track'] for tp in catalog] == [0, 1, 2]
+    for tp in tracks:
+        kc.load_trackpoints(device, tp['track'])
+        assert list(kc.get_trackpoints(device, tp['track'])) == tp['points']
+    requests = sim.requests
+    # cached tracks are not downloaded again
+    kc.load_trackpoints(device, 0)
+    assert sim.requests == requests
+
+
+def test_resume(simulator, open_port, cache, caplog):
+    sim = simulator([make_track(0, 1000)])
+    kc = cache(open_port(sim))
+    device = kc.get_device(kc.get_information()['serialnumber'])
+    kc.get_trackpoint_catalog(device)
+    kc.load_trackpoints(device, 0)
+    interrupt(kc, device, 0, 5)
+    with caplog.at_level(logging.INFO, logger=kc.log.name):
+        kc.load_trackpoints(device, 0)
+    assert 'Resuming download of track 0 after 300 points' in caplog.text
+    assert list(kc.get_trackpoints(device, 0)) == sim.tracks[0]['points']
+
+
+def test_resume_changed_track(simulator, open_port, cache, caplog):
+    sim = simulator([make_track(0, 1000)])
+    kc = cache(open_port(sim))
+    device = kc.get_device(kc.get_information()['serialnumber'])
+    kc.get_trackpoint_catalog(device)
+    kc.load_trackpoints(device, 0)
+    interrupt(kc, device, 0, 10)
+    # the device track no longer matches the cached chunks, whose headers
+    # hold the track duration
+    points = sim.tracks[0]['points']
+    points[200] = points[200][:5] + (20,)
+    with caplog.at_level(logging.WARNING, logger=kc.log.name):
+        kc.load_trackpoints(device, 0)
+    assert 'differs from the cached one' in caplog.text
+    assert list(kc.get_trackpoints(device, 0)) == points
+
+
+def test_reader_failure(simulator, open_port, cache, caplog):
+    sim = simulator([make_track(0, 1000)])
+    port = open_port(sim)
+    kc = cache(port)
+    device = kc.get_device(kc.get_information()['serialnumber'])
+    kc.get_trackpoint_catalog(device)
+    fetch = port._fetch_trackpoints
+    def failing_fetch(count):
+        # the reader thread fails after 10 device responses
+        for (pos, resp) in enumerate(fetch(count)):
+            if pos == 10:
+                raise AssertionError('No answer from device')
+            yield resp
+    read = port.read_trackpoints
+    def late_read(track):
+        # the cache only catches up once the reader thread has failed
+        (header, chunks) = read(track)
+        time.sleep(0.5)
+        return (header, chunks)
+    port._fetch_trackpoints = failing_fetch
+    port.read_trackpoints = late_read
+    with pytest.raises(AssertionError):
+        kc.load_trackpoints(device, 0)
+    c = kc.db.execute('SELECT COUNT(*),SUM(count) FROM tp_chunks')
+    assert c.fetchone() == (10, 10*KeymazeSimulator.CHUNK)
+    c = kc.db.execute('SELECT COUNT(*) FROM tp_points')
+    assert c.fetchone()[0] == 10*KeymazeSimulator.CHUNK
+    port._fetch_trackpoints = fetch
+    port.read_trackpoints = read
+    with caplog.at_level(logging.INFO, logger=kc.log.name):
+        kc.load_trackpoints(device, 0)
+    assert 'Resuming download of track 0 after 600 points' in caplog.text
+    assert list(kc.get_trackpoints(device, 0)) == sim.tracks[0]['points']
+
+
+def test_rollups(simulator, open_port, cache):
+    tracks = [make_track(0, 100), make_track(1, 100, 2), make_track(2, 100, 400)]
+    sim = simulator(tracks)
+    kc = cache(open_port(sim))
+    device = kc.get_device(kc.get_information()['serialnumber'])
+    kc.get_trackpoint_catalog(device)
+    # the totals of all the catalog entries, whether they are loaded or not
+    rollups = kc.get_rollups(device, 'year')
+    assert [r['key'] for r in rollups] == ['2010', '2011']
+    assert [r['count'] for r in rollups] == [2, 1]
+    assert [r['climb'] for r in rollups] == \
+        [tracks[0]['climb']+tracks[1]['climb'], tracks[2]['climb']]
+    assert tracks[0]['climb'] > 0
+    # loading the tracks does not change the totals
+    for tp in tracks:
+        kc.load_trackpoints(device, tp['track'])
+    assert kc.get_rollups(device, 'year') == rollups
+
+
+def test_cached_analytics(simulator, open_port, cache):
+    pytest.importorskip('numpy')
+    import analytics
+    sim = simulator([make_track(0, 1000)])
+    kc = cache(open_port(sim))
+    device = kc.get_device(kc.get_information()['serialnumber'])
+    kc.get_trackpoint_catalog(device)
+    kc.load_trackpoints(device, 0)
+    stats = kc.get_analytics(device, 0, 190)
+    assert len(stats['splits']) == int(stats['distance']//analytics.SPLIT) > 0
+    # the distance sum may end right below a split boundary that the
+    # cumulated distance reaches
+    kc.db.execute('UPDATE tp_analytics SET distance=?',
+                  (len(stats['splits'])*analytics.SPLIT-1e-9,))
+    assert kc.get_analytics(device, 0, 190)['splits'] == stats['splits']
+
+
+def delay_response(sim, response, delay):
+    """Delay a trackpoint response of a simulated device, counted from 0"""
+    from keymaze import KeymazePort
+    send = sim._send
+    responses = []
+    def late_send(command, payload):
+        if command == KeymazePort.CMD_TP_GET_NEXT:
+            if len(responses) == response:
+                time.sleep(delay)
+            responses.append(command)
+        send(command, payload)
+    sim._send = late_send
+
+
+def test_trackpoint_timeouts(simulator, open_port, cache):
+    from keymaze import KeymazePort
+    sim = simulator([make_track(0, 200)])
+    port = open_port(sim)
+    kc = cache(port)
+    device = kc.get_device(kc.get_information()['serialnumber'])
+    kc.get_trackpoint_catalog(device)
+    kc.load_trackpoints(device, 0)
+    # a fast link shortens the timeouts, but not the ones of the trackpoint
+    # requests, which cannot be sent again safely
+    assert port._header_timeout(KeymazePort.CMD_INFO_GET) == \
+        KeymazePort.MIN_TIMEOUT
+    for command in KeymazePort.SEQUENTIAL:
+        assert port._header_timeout(command) == KeymazePort.MAX_TIMEOUT
+    latencies = port.stats.report()['command_latency']
+    assert sorted(latencies) == ['0x78', '0x80', '0x81', '0x85']
+
+
+def test_late_trackpoint_response(simulator, open_port, cache):
+    sim = simulator([make_track(0, 1200)])
+    kc = cache(open_port(sim))
+    device = kc.get_device(kc.get_information()['serialnumber'])
+    kc.get_trackpoint_catalog(device)
+    delay_response(sim, 4, 1.3)
+    kc.load_trackpoints(device, 0)
+    assert list(kc.get_trackpoints(device, 0)) == sim.tracks[0]['points']
+
+
+def test_missed_chunk(simulator, open_port, cache):
+    sim = simulator([make_track(0, 1200)])
+    port = open_port(sim)
+    kc = cache(port)
+    device = kc.get_device(kc.get_information()['serialnumber'])
+    kc.get_trackpoint_catalog(device)
+    # the request is sent again before the late response is received, so
+    # the device moves on to the next chunk
+    port.MAX_TIMEOUT = 0.3
+    delay_response(sim, 4, 0.6)
+    with pytest.raises(AssertionError) as exc:
+        kc.load_trackpoints(device, 0)
+    assert 'received 1140 / 1200 points' in str(exc.value)
+    c = kc.db.execute('SELECT COUNT(*) FROM tp_chunks')
+    assert c.fetchone()[0] == 0
+    c = kc.db.execute('SELECT COUNT(*) FROM tp_summary')
+    assert c.fetchone()[0] == 0
+
+
+def test_silent_device(simulator, open_port, cache):
+    from keymaze import KeymazePort
+    sim = simulator([make_track(0, 10)])
+    sim._send = lambda command, payload: None
+    port = open_port(sim)
+    port.MAX_TIMEOUT = 0.2
+    start = time.time()
+    with pytest.raises(AssertionError):
+        cache(port).get_information()
+    # the backoff never waits longer than the longest timeout
+    assert time.time()-start < KeymazePort.KNOCKS*port.MAX_TIMEOUT+0.5
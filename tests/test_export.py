@@ -0,0 +1,62 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from optparse import Values
+import sys
+import time
+
+import pytest
+
+import pykmaze
+
+TRACK = { 'id' : 2, 'track' : 7,
+          'start' : int(time.mktime((2010, 1, 1, 10, 30, 0, 0, 0, -1))) }
+
+
+def test_batch_output():
+    assert pykmaze.batch_output('out/run.kml', TRACK) == \
+        'out/run-20100101-1030.kml'
+    assert pykmaze.batch_output('run-%(id)d-%(track)d.gpx', TRACK) == \
+        'run-3-7.gpx'
+
+
+def test_batch_output_percent():
+    assert pykmaze.batch_output('100%/run.kml', TRACK) == \
+        '100%/run-20100101-1030.kml'
+    assert pykmaze.batch_output('100%/%(id)d%.kml', TRACK) == '100%/3%.kml'
+    with pytest.raises(AssertionError):
+        pykmaze.batch_output('%(name)s.kml', TRACK)
+
+
+def test_batch_export_failures(log, monkeypatch):
+    tracks = [dict(TRACK, id=idx, track=idx) for idx in range(4)]
+    exported = []
+    def export_track(cache, device, track_info, outputs, settings):
+        if track_info['track'] == 1:
+            raise AssertionError('No such track')
+        if track_info['track'] == 2:
+            raise ValueError('Broken track')
+        exported.append(track_info['track'])
+    monkeypatch.setattr(pykmaze, 'export_track', export_track)
+    monkeypatch.setattr(pykmaze, 'KeymazeCache', lambda log, storage: None)
+    with pytest.raises(AssertionError) as exc:
+        pykmaze.batch_export(log, 'cache.sqlite', 1, tracks,
+                             { 'kml' : 'run.kml' }, {}, 1)
+    assert str(exc.value) == '2 tracks failed to export: 2, 3'
+    # the tracks that follow a failure are still exported
+    assert exported == [0, 3]
+
+
+def test_numpy_options(monkeypatch):
+    options = Values({ 'simplify' : 'dp', 'analytics' : None, 'lod' : True })
+    pykmaze.check_numpy(options)
+    monkeypatch.setitem(sys.modules, 'numpy', None)
+    with pytest.raises(AssertionError) as exc:
+        pykmaze.check_numpy(options)
+    assert str(exc.value) == 'NumPy is required by the -O, -L options'
+    options.simplify = options.lod = None
+    pykmaze.check_numpy(options)
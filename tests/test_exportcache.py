@@ -0,0 +1,92 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import os
+
+import pytest
+
+from conftest import make_track
+from db import KeymazeCache
+from exportcache import ExportCache
+
+SETTINGS = { 'trim' : None,
+             'simplify' : None,
+             'tolerance' : None,
+             'zoffset' : 0,
+             'extrude' : True,
+             'gpx_version' : '1.0',
+             'lod' : None }
+
+
+@pytest.fixture
+def exports(log, tmpdir):
+    cache = KeymazeCache(log, str(tmpdir.join('cache.sqlite')))
+    return ExportCache(cache, str(tmpdir.join('exports')), 1000)
+
+
+def render(tmpdir, name, size):
+    path = str(tmpdir.join(name))
+    with open(path, 'wb') as out:
+        out.write(name[0]*size)
+    return path
+
+
+def test_keys():
+    key = ExportCache(None, '.', 0).key
+    keys = set([key(1, 2, 'kml', 'out', SETTINGS),
+                key(2, 2, 'kml', 'out', SETTINGS),
+                key(1, 3, 'kml', 'out', SETTINGS),
+                key(1, 2, 'gpx', 'out', SETTINGS),
+                key(1, 2, 'kml', 'other', SETTINGS),
+                key(1, 2, 'kml', 'out', dict(SETTINGS, zoffset=10)),
+                key(1, 2, 'kml', 'out', dict(SETTINGS, simplify='dp'))])
+    assert len(keys) == 7
+    # settings that do not change the output are ignored
+    assert key(1, 2, 'kml', 'out', dict(SETTINGS, exports=('x', 1))) == \
+        key(1, 2, 'kml', 'out', SETTINGS)
+
+
+def test_fetch(exports, tmpdir):
+    output = str(tmpdir.join('copy.kml'))
+    assert not exports.fetch('a'*40, output)
+    exports.store('a'*40, 1, 0, render(tmpdir, 'a.kml', 100))
+    assert exports.fetch('a'*40, output)
+    assert open(output, 'rb').read() == 'a'*100
+
+
+def test_least_recently_used_eviction(exports, tmpdir):
+    exports.store('a'*40, 1, 0, render(tmpdir, 'a.kml', 400))
+    exports.store('b'*40, 1, 1, render(tmpdir, 'b.kml', 400))
+    output = str(tmpdir.join('copy.kml'))
+    # a is now more recently used than b
+    assert exports.fetch('a'*40, output)
+    exports.store('c'*40, 1, 2, render(tmpdir, 'c.kml', 400))
+    assert sorted(os.listdir(exports.path)) == ['a'*40, 'c'*40]
+    assert not exports.fetch('b'*40, output)
+    assert exports.fetch('a'*40, output)
+
+
+def test_missing_file(exports, tmpdir):
+    exports.store('a'*40, 1, 0, render(tmpdir, 'a.kml', 100))
+    os.unlink(os.path.join(exports.path, 'a'*40))
+    assert not exports.fetch('a'*40, str(tmpdir.join('copy.kml')))
+    assert exports.cache.get_exports() == []
+
+
+def test_reloaded_track(log, tmpdir, simulator, open_port):
+    sim = simulator([make_track(0, 100)])
+    cache = KeymazeCache(log, str(tmpdir.join('cache.sqlite')),
+                         open_port(sim))
+    device = cache.get_device(cache.get_information()['serialnumber'])
+    cache.get_trackpoint_catalog(device)
+    cache.load_trackpoints(device, 0)
+    exports = ExportCache(cache, str(tmpdir.join('exports')), 1000)
+    exports.store('a'*40, device, 0, render(tmpdir, 'a.kml', 100))
+    cache._load_trackpoints(device, 0)
+    assert not exports.fetch('a'*40, str(tmpdir.join('copy.kml')))
+    exports.prune()
+    assert os.listdir(exports.path) == []
@@ -0,0 +1,94 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import struct
+
+import pytest
+
+from frame import FrameCodec, xor_checksum
+
+
+def response(command, payload):
+    """Build a device response frame"""
+    frame = struct.pack('>BH', command, len(payload)) + payload
+    return frame + chr(reduce(lambda x, y: x ^ ord(y), frame[1:], 0))
+
+
+@pytest.mark.parametrize('data', ['', '\x5a', 'abc', '\xff'*1000,
+                                  ''.join([chr(i % 256) for i in range(777)])])
+def test_xor_checksum(data):
+    assert xor_checksum(data) == reduce(lambda x, y: x ^ ord(y), data, 0)
+    assert xor_checksum(data, 0x5a) == xor_checksum(data) ^ 0x5a
+
+
+def test_encode():
+    codec = FrameCodec(0x02)
+    req = codec.encode(0x80, '\x00\x01\x00\x07')
+    assert req[:4] == '\x02\x00\x05\x80'
+    assert req[4:-1] == '\x00\x01\x00\x07'
+    assert ord(req[-1]) == xor_checksum(req[1:-1])
+
+
+def test_decode_partial_feeds():
+    codec = FrameCodec(0x02)
+    frame = response(0x85, 'hello world')
+    for pos in range(len(frame)-1):
+        codec.feed(frame[pos])
+        assert codec.decode() is None
+    assert codec.header() == (0x85, 11)
+    codec.feed(frame[-1])
+    (command, payload) = codec.decode()
+    assert (command, payload.tobytes()) == (0x85, 'hello world')
+    assert codec.available() == 0
+
+
+def test_decode_consecutive_frames():
+    codec = FrameCodec(0x02)
+    codec.feed(response(0x81, 'first') + response(0x8a, ''))
+    (command, payload) = codec.decode()
+    assert (command, payload.tobytes()) == (0x81, 'first')
+    (command, payload) = codec.decode()
+    assert (command, payload.tobytes()) == (0x8a, '')
+    assert codec.decode() is None
+
+
+def test_resync_after_checksum_error():
+    codec = FrameCodec(0x02)
+    bad = bytearray(response(0x81, 'corrupted'))
+    bad[5] ^= 0x10
+    codec.feed(str(bad) + response(0x81, 'valid'))
+    with pytest.raises(AssertionError):
+        codec.decode()
+    # the corrupted frame has been skipped over
+    (command, payload) = codec.decode()
+    assert (command, payload.tobytes()) == (0x81, 'valid')
+
+
+def test_reset_discards_pending_bytes():
+    codec = FrameCodec(0x02)
+    codec.feed('\x81\x00\x10garbage')
+    codec.reset()
+    assert codec.available() == 0
+    codec.feed(response(0x85, 'info'))
+    assert codec.decode()[1].tobytes() == 'info'
+
+
+def test_buffer_reuse():
+    # a small buffer forces pending bytes to move back to its start
+    codec = FrameCodec(0x02, size=64)
+    frame = response(0x81, 'x'*20)
+    for count in range(50):
+        codec.feed(frame[:10])
+        assert codec.decode() is None
+        codec.feed(frame[10:])
+        assert codec.decode()[1].tobytes() == 'x'*20
+
+
+def test_buffer_overflow():
+    codec = FrameCodec(0x02, size=16)
+    with pytest.raises(AssertionError):
+        codec.feed('\x81\x00\x20' + 'x'*20)
@@ -0,0 +1,39 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from StringIO import StringIO
+import time
+
+import pytest
+
+from conftest import make_track
+from gpx import GpxDoc, GpxWriter
+from track import Track
+
+DOCTIME = 1262336400
+START = 1262332800
+
+
+@pytest.mark.parametrize('count', [500, 0])
+def test_writer_matches_doc(monkeypatch, count):
+    track = make_track(0, count)
+    points = Track()
+    points.extend(track['points'])
+    scale = points.DEGREE
+    monkeypatch.setattr(time, 'time', lambda: DOCTIME)
+    doc = GpxDoc('track', START)
+    monkeypatch.undo()
+    doc.add_trackpoints([(lat/scale, lon/scale, alt, speed, heart, delta) \
+                             for (lat, lon, alt, speed, heart, delta) \
+                             in points], 5)
+    expected = StringIO()
+    doc.write(expected)
+    out = StringIO()
+    gpx = GpxWriter(out, 'track', START, doctime=DOCTIME)
+    gpx.add_trackpoints(points, 5)
+    gpx.close()
+    assert out.getvalue() == expected.getvalue()
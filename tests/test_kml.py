@@ -0,0 +1,126 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from StringIO import StringIO
+import xml.etree.ElementTree as ET
+import zipfile
+
+import pytest
+
+from conftest import make_track
+from kml import KmlWriter, KmzLodWriter, kmz_output
+from pykmaze import trim_lod
+from track import Track
+
+NS = '{http://www.opengis.net/kml/2.2}'
+
+
+def track(count):
+    points = Track()
+    points.extend(make_track(0, count)['points'])
+    return points
+
+
+def render(points, name='run', zoffset=0):
+    out = StringIO()
+    kml = KmlWriter(out, name, zoffset)
+    kml.add_trackpoints(points)
+    kml.close()
+    return out.getvalue()
+
+
+def expected(points):
+    return [('%.6f' % (lon/points.DEGREE), '%.6f' % (lat/points.DEGREE),
+             str(alt)) for (lat, lon, alt, speed, heart, delta) in points]
+
+
+def coordinates(data):
+    root = ET.fromstring(data)
+    text = root.find('%sDocument/%sPlacemark/%sLineString/%scoordinates' % \
+                         (NS, NS, NS, NS)).text or ''
+    return [tuple(line.split(',')) for line in text.split('\n') if line]
+
+
+def test_writer(monkeypatch):
+    # several chunks, the last one partial
+    monkeypatch.setattr(KmlWriter, 'CHUNK', 64)
+    points = track(200)
+    data = render(points, 'run <1>', 5)
+    root = ET.fromstring(data)
+    assert root.find('%sDocument/%sPlacemark/%sname' % (NS, NS, NS)).text == \
+        'run <1>'
+    assert coordinates(data) == \
+        [('%.6f' % (lon/points.DEGREE), '%.6f' % (lat/points.DEGREE),
+          str(alt+5)) for (lat, lon, alt, speed, heart, delta) in points]
+    style = root.find('%sDocument/%sStyle' % (NS, NS))
+    assert root.find('%sDocument/%sPlacemark/%sstyleUrl' % \
+                         (NS, NS, NS)).text == '#%s' % style.get('id')
+
+
+def test_writer_empty():
+    assert coordinates(render(Track())) == []
+
+
+def test_kmz_output(tmpdir):
+    points = track(100)
+    path = str(tmpdir.join('run.kmz'))
+    with kmz_output(path) as out:
+        out.write(render(points))
+    kmz = zipfile.ZipFile(path)
+    assert kmz.namelist() == ['doc.kml']
+    assert kmz.read('doc.kml') == render(points)
+    # the spooled document is removed
+    assert tmpdir.listdir() == [tmpdir.join('run.kmz')]
+
+
+def test_kmz_output_failure(tmpdir):
+    path = str(tmpdir.join('run.kmz'))
+    with pytest.raises(AssertionError):
+        with kmz_output(path) as out:
+            out.write('<?xml')
+            raise AssertionError('Export failed')
+    # neither the archive nor the spooled document are left behind
+    assert tmpdir.listdir() == []
+
+
+def test_trim_lod():
+    levels = [(50.0, [0, 40, 100, 199]), (10.0, range(0, 200, 10)+[199])]
+    assert trim_lod(levels, 20, 150) == \
+        [(50.0, [0, 20, 80, 129]), (10.0, range(0, 130, 10)+[129])]
+    # both ends of the range are kept, even if they are not in the level
+    assert trim_lod(levels, 0, 200) == levels
+    assert trim_lod(levels, 5, 6) == [(50.0, [0]), (10.0, [0])]
+
+
+def test_lod_writer(tmpdir):
+    points = track(2500)
+    levels = [(50.0, range(0, 2500, 100)+[2499]),
+              (10.0, range(0, 2500, 10)+[2499])]
+    path = str(tmpdir.join('run.kmz'))
+    KmzLodWriter(path, 'run', 0).write(points, levels)
+    kmz = zipfile.ZipFile(path)
+    names = kmz.namelist()
+    # viewers open the first document of the archive
+    assert names[0] == 'doc.kml'
+    links = ET.fromstring(kmz.read('doc.kml')).findall('.//%shref' % NS)
+    assert [link.text for link in links] == names[1:]
+    assert sorted(names[1:]) == ['tiles/%d-%d.kml' % (tile, level) \
+                                     for tile in range(3)
+                                     for level in range(3)]
+    # each level is split into tiles of TILE points, which join up
+    for (level, taken) in enumerate([points.take(indices) \
+                                         for (tolerance, indices) in levels]+
+                                    [points]):
+        coords = []
+        for tile in range(3):
+            tcoords = coordinates(kmz.read('tiles/%d-%d.kml' % (tile, level)))
+            if coords:
+                assert tcoords[0] == coords[-1]
+                tcoords = tcoords[1:]
+            coords.extend(tcoords)
+        assert coords == expected(taken)
+    assert len(coordinates(kmz.read('tiles/0-2.kml'))) == KmzLodWriter.TILE
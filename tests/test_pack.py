@@ -0,0 +1,58 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from array import array
+import random
+
+import pytest
+
+import pack
+from pack import pack_column, unpack_column
+
+COLUMNS = [
+    [],
+    [0],
+    [1, -1, 0, 127, 128, -128, -129, 16383, 16384],
+    [2**31-1, -2**31, 2**31-1, 0],
+    [45000000+20*i for i in range(1000)],
+    [random.Random(seed).randint(-2**31, 2**31-1) for seed in range(500)],
+]
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def decoder(request, monkeypatch):
+    """Run the decoding tests with and without NumPy"""
+    if request.param == 'python':
+        monkeypatch.setattr(pack, '_numpy', False)
+    else:
+        pytest.importorskip('numpy')
+        monkeypatch.setattr(pack, '_numpy', None)
+    return request.param
+
+
+@pytest.mark.parametrize('values', COLUMNS)
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(decoder, values, compress):
+    data = pack_column(array('i', values), compress)
+    decoded = unpack_column(data, len(values), compress)
+    assert isinstance(decoded, array)
+    assert decoded.typecode == 'i'
+    assert list(decoded) == values
+
+
+def test_small_deltas_take_one_byte():
+    values = [1000+(i % 7)-3 for i in range(100)]
+    # the first value is a delta from zero
+    assert len(pack_column(values)) == 2+99
+
+
+def test_count_mismatch(decoder):
+    data = pack_column([1, 2, 3])
+    with pytest.raises(AssertionError):
+        unpack_column(data, 4)
+    with pytest.raises(AssertionError):
+        unpack_column(data, 2)
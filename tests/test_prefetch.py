@@ -0,0 +1,64 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import threading
+import time
+
+import pytest
+
+from prefetch import Prefetcher
+
+
+def wait_ready(prefetcher, count):
+    deadline = time.time()+5
+    while prefetcher.ready() < count and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_items():
+    assert list(Prefetcher(iter(range(100)), 4, lambda x: 2*x)) == \
+        range(0, 200, 2)
+
+
+def test_error_after_items():
+    def producer():
+        yield 1
+        yield 2
+        raise ValueError('producer failure')
+    prefetcher = Prefetcher(producer(), 4)
+    # let the producer fail
+    time.sleep(0.2)
+    # the error is not an item to consume
+    assert prefetcher.ready() == 2
+    assert prefetcher.next() == 1
+    assert prefetcher.next() == 2
+    assert prefetcher.ready() == 0
+    with pytest.raises(ValueError):
+        prefetcher.next()
+
+
+def test_end_is_not_ready():
+    prefetcher = Prefetcher(iter([1]), 4)
+    wait_ready(prefetcher, 1)
+    time.sleep(0.1)
+    assert prefetcher.ready() == 1
+    assert list(prefetcher) == [1]
+
+
+def test_bounded_queue():
+    produced = []
+    def producer():
+        for item in range(100):
+            produced.append(item)
+            yield item
+    prefetcher = Prefetcher(producer(), 4)
+    wait_ready(prefetcher, 4)
+    time.sleep(0.1)
+    # the producer is blocked on the fifth item
+    assert len(produced) == 5
+    prefetcher.close()
+    assert not [t for t in threading.enumerate() if t.name == 'Prefetcher']
@@ -0,0 +1,89 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import math
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from simplify import MODES, simplify
+
+# about one meter, in degrees of latitude
+METER = 1.0/111195
+
+
+def line(count, step=10.0):
+    """Positions along a straight north-bound line, step meters apart"""
+    lat = [45.0+pos*step*METER for pos in range(count)]
+    return (lat, [5.0]*count, [200.0]*count)
+
+
+def zigzag(count, step=10.0, offset=50.0):
+    """Positions that swing offset meters east and west at each step"""
+    (lat, lon, alt) = line(count, step)
+    scale = METER/math.cos(math.radians(45.0))
+    lon = [5.0+(pos % 2)*offset*scale for pos in range(count)]
+    return (lat, lon, alt)
+
+
+@pytest.mark.parametrize('mode', sorted(MODES))
+def test_straight_line(mode):
+    keep = simplify(*line(500)+(mode,))
+    assert list(keep) == [0, 499]
+
+
+@pytest.mark.parametrize('mode', sorted(MODES))
+def test_significant_points_are_kept(mode):
+    keep = simplify(*zigzag(200)+(mode,))
+    assert list(keep) == range(200)
+
+
+@pytest.mark.parametrize('mode', sorted(MODES))
+def test_indices(mode):
+    (lat, lon, alt) = line(300)
+    # small deviations around a straight line
+    rnd = numpy.random.RandomState(0)
+    lon = 5.0+rnd.normal(0, 3*METER, 300)
+    keep = simplify(lat, lon, alt, mode)
+    assert keep[0] == 0
+    assert keep[-1] == 299
+    assert (numpy.diff(keep) > 0).all()
+    assert 2 <= len(keep) < 300
+
+
+@pytest.mark.parametrize('mode', sorted(MODES))
+@pytest.mark.parametrize('count', [0, 1, 2])
+def test_short_tracks(mode, count):
+    assert list(simplify(*line(count)+(mode,))) == range(count)
+
+
+def test_douglas_peucker_tolerance():
+    (lat, lon, alt) = line(101)
+    lon = list(lon)
+    # a single 20 m deviation in the middle of the line
+    lon[50] += 20*METER/math.cos(math.radians(45.0))
+    assert list(simplify(lat, lon, alt, 'dp', 30.0)) == [0, 100]
+    assert 50 in simplify(lat, lon, alt, 'dp', 10.0)
+
+
+@pytest.mark.parametrize('mode', ['dp', 'vw'])
+def test_stationary_stretch(mode):
+    (lat, lon, alt) = zigzag(100)
+    # the device keeps recording while the athlete does not move
+    pause = 20000
+    lat = lat[:50]+[lat[50]]*pause+lat[50:]
+    lon = lon[:50]+[lon[50]]*pause+lon[50:]
+    keep = simplify(lat, lon, [200.0]*len(lat), mode)
+    # a single point of the stretch is kept
+    assert len(keep) == 100
+    assert [(lat[pos], lon[pos]) for pos in keep] == zip(*zigzag(100)[:2])
+
+
+def test_unsupported_mode():
+    with pytest.raises(AssertionError):
+        simplify(*line(10)+('spline',))
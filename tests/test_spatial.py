@@ -0,0 +1,70 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import pytest
+
+from conftest import make_track
+from db import KeymazeCache
+from track import Track
+
+
+@pytest.fixture
+def cache(log, tmpdir, simulator, open_port):
+    """Cache of two tracks, the second one being far east of the first"""
+    far = make_track(1, 300, 1)
+    far['points'] = [(p[0], p[1]+1000000) + p[2:] for p in far['points']]
+    sim = simulator([make_track(0, 300), far])
+    kc = KeymazeCache(log, str(tmpdir.join('cache.sqlite')), open_port(sim))
+    device = kc.get_device(kc.get_information()['serialnumber'])
+    for tp in kc.get_trackpoint_catalog(device):
+        kc.load_trackpoints(device, tp['track'])
+    return kc
+
+
+def segments(cache):
+    return cache.db.execute('SELECT COUNT(*) FROM tp_segments').fetchone()[0]
+
+
+def test_index(cache):
+    # downloads index the tracks; segments share their last point with the
+    # next one
+    assert segments(cache) == 2*5
+    cache._load_trackpoints(1, 0)
+    assert segments(cache) == 2*5
+
+
+def test_index_backfill(cache):
+    # tracks loaded before the index existed are indexed on the first query
+    cache._unindex_track(1, 0)
+    assert segments(cache) == 5
+    points = cache.get_trackpoints(1, 0)
+    (lat, lon) = [v/Track.DEGREE for v in points[100][:2]]
+    assert [m[1] for m in cache.find_tracks(lat, lon, lat, lon)] == [0]
+    assert segments(cache) == 2*5
+
+
+def test_find_tracks(cache):
+    points = cache.get_trackpoints(1, 0)
+    bounds = points.bounds()
+    matches = cache.find_tracks(bounds['minlat'], bounds['minlon'],
+                                bounds['maxlat'], bounds['maxlon'])
+    assert matches == [(1, 0, [(0, 300)])]
+    # a box around a single point only matches the segments next to it
+    (lat, lon) = [v/Track.DEGREE for v in points[100][:2]]
+    matches = cache.find_tracks(lat, lon, lat, lon, device=1)
+    assert len(matches) == 1
+    (device, track, ranges) = matches[0]
+    assert track == 0
+    for (first, stop) in ranges:
+        assert first <= 100 < stop
+    assert cache.find_tracks(lat, lon, lat, lon, device=2) == []
+
+
+def test_find_tracks_near(cache):
+    (lat, lon) = [v/Track.DEGREE for v in cache.get_trackpoints(1, 1)[0][:2]]
+    assert [m[1] for m in cache.find_tracks_near(lat, lon+0.001, 200)] == [1]
+    assert cache.find_tracks_near(lat+0.1, lon, 200) == []
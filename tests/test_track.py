@@ -0,0 +1,33 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+from conftest import make_track
+from track import Track
+
+
+def track(count):
+    points = Track()
+    points.extend(make_track(0, count)['points'])
+    return points
+
+
+def test_take():
+    points = track(100)
+    taken = points.take([0, 10, 99])
+    assert list(taken.column('lat')) == \
+        [points[pos][0] for pos in (0, 10, 99)]
+    # the time deltas of the left out points are carried over
+    assert list(taken.column('delta')) == [10, 100, 890]
+
+
+def test_take_view():
+    points = track(100)
+    view = points[20:60]
+    assert list(view.take([0, 5, 39])) == \
+        list(Track(view.columns()).take([0, 5, 39]))
+    # the deltas of a view are summed up from the start of the view
+    assert list(view.take([5]).column('delta')) == [60]
@@ -0,0 +1,65 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import time
+
+import pytest
+
+import pykmaze
+from track import Track
+
+# a two hour track, starting at 23:00 local time, one point per minute
+TRACK = { 'start' : int(time.mktime((2010, 1, 1, 23, 0, 0, 0, 0, -1))),
+          'time' : 7200 }
+
+
+def points():
+    track = Track()
+    track.extend([(45000000, 5000000, 100, 0, 0, pos and 600) \
+                      for pos in range(121)])
+    return track
+
+
+def trim_range(*trims):
+    return pykmaze.trim_range(TRACK, points(), pykmaze.parse_trim(trims))
+
+
+def test_parse_trim():
+    assert pykmaze.parse_trim(['+10:00', '-01:00:05', '12:00:00', '30']) == \
+        [('+', 600), ('-', 3605), (None, 43200), (None, 30)]
+    assert pykmaze.parse_trim(['2010-01-02T00:15:00']) == \
+        [('@', TRACK['start']+4500)]
+    for trim in ('+1:00', '10:00:00:00', '2010-01-02', 'noon'):
+        with pytest.raises(AssertionError):
+            pykmaze.parse_trim([trim])
+
+
+def test_relative():
+    assert trim_range('+10:00') == (10, 121)
+    assert trim_range('+10:00', '-10:00') == (10, 111)
+    assert trim_range('-10:00') == (110, 121)
+
+
+def test_time_of_day():
+    assert trim_range('23:30:00') == (30, 121)
+    # before the start of the track, on the same day
+    assert trim_range('22:00:00', '23:10:30') == (0, 11)
+
+
+def test_over_midnight():
+    # the end bound is on the next day
+    assert trim_range('23:30:00', '00:30:00') == (30, 91)
+    assert trim_range('00:15:00') == (75, 121)
+
+
+def test_absolute():
+    assert trim_range('2010-01-01T23:45:00', '2010-01-02 00:45:00') == \
+        (45, 106)
+    # bounds out of the track yield an empty range
+    assert trim_range('2010-01-03T00:00:00') == (121, 121)
+    assert trim_range('2010-01-01T23:30:00', '2010-01-01T23:00:00') == \
+        (30, 30)
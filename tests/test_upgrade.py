@@ -0,0 +1,106 @@
+#-----------------------------------------------------------------------------
+# Communicate w/ a Decathlon Keymaze 500/700 devices
+#-----------------------------------------------------------------------------
+# @author Emmanuel Blot <manu.blot@gmail.com> (c) 2009
+# @license MIT License, see LICENSE file
+#-----------------------------------------------------------------------------
+
+import sqlite3
+
+import pytest
+
+from conftest import make_track
+from db import KeymazeCache, sqlparams
+from util import inttime
+
+# tables, and count of their rows, each upgrade creates from the tracks of
+# a former cache
+UPGRADES = { 1 : (('tp_summary', 2),),
+             2 : (('tp_packed', 0), ('cache_info', 1)),
+             3 : (('tp_chunks', 0),),
+             4 : (('dev_catalog', 0),),
+             5 : (('tp_segments', 0), ('tp_bbox', 0)),
+             6 : (('tp_analytics', 0),),
+             7 : (('rollups', 5),),
+             8 : (('tp_lod', 0),),
+             9 : (('exports', 0),),
+             10 : (('tp_analytics', 0),),
+             11 : (('rollups', 5),) }
+
+TRACKS = (make_track(0, 200), make_track(1, 100, 40))
+
+
+def cache_class(version):
+    """Cache class whose database layout stops at the specified version"""
+    class Cache(KeymazeCache):
+        SCHEMA_VERSION = version
+    return Cache
+
+
+def create_cache(log, path):
+    """Create a cache with the layout of the first release, which stores the
+       trackpoints as plain rows"""
+    cache_class(0)(log, path).db.close()
+    db = sqlite3.connect(path)
+    db.execute("INSERT INTO dev_info (serialnumber,name,user,age) "
+               "VALUES ('SIM1','KEYMAZE','Tester',30)")
+    for (idx, tp) in enumerate(TRACKS):
+        duration = sum([p[5] for p in tp['points']])//10
+        values = (1, inttime(tp['start']), duration, tp['distance'], 0, 0, 0,
+                  0, tp['climb'], 0, tp['track'], idx)
+        db.execute('INSERT INTO tp_catalog VALUES (%s)' % sqlparams(values),
+                   values)
+        db.executemany('INSERT INTO tp_points VALUES (%s)' % \
+                           sqlparams(KeymazeCache.TRACKPOINT),
+                       [(1, tp['track'], pos+1)+p \
+                            for (pos, p) in enumerate(tp['points'])])
+    db.commit()
+    db.close()
+
+
+def user_version(path):
+    db = sqlite3.connect(path)
+    try:
+        return db.execute('PRAGMA user_version').fetchone()[0]
+    finally:
+        db.close()
+
+
+def test_all_upgrades_are_tested():
+    assert sorted(UPGRADES) == range(1, KeymazeCache.SCHEMA_VERSION+1)
+
+
+@pytest.mark.parametrize('version', sorted(UPGRADES))
+def test_upgrade(log, tmpdir, version):
+    path = str(tmpdir.join('cache.sqlite'))
+    create_cache(log, path)
+    cache_class(version-1)(log, path).db.close()
+    assert user_version(path) == version-1
+    cache = cache_class(version)(log, path)
+    assert user_version(path) == version
+    for (table, count) in UPGRADES[version]:
+        c = cache.db.execute('SELECT COUNT(*) FROM %s' % table)
+        assert c.fetchone()[0] == count
+    cache.db.close()
+    # the following upgrades keep the cached tracks available
+    cache = KeymazeCache(log, path)
+    assert user_version(path) == KeymazeCache.SCHEMA_VERSION
+    for tp in TRACKS:
+        assert list(cache.get_trackpoints(1, tp['track'])) == tp['points']
+    catalog = cache.get_trackpoint_catalog(1)
+    assert [tp['altmin'] for tp in catalog] == \
+        [min([p[2] for p in tp['points']]) for tp in TRACKS]
+    assert len(cache.find_tracks(-90, -180, 90, 180)) == len(TRACKS)
+    rollups = cache.get_rollups(1, 'year')
+    assert [r['count'] for r in rollups] == [2]
+    assert rollups[0]['climb'] == sum([tp['climb'] for tp in TRACKS])
+
+
+def test_newer_cache_is_rejected(log, tmpdir):
+    path = str(tmpdir.join('cache.sqlite'))
+    KeymazeCache(log, path).db.close()
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA user_version=%d' % (KeymazeCache.SCHEMA_VERSION+1))
+    db.close()
+    with pytest.raises(AssertionError):
+        KeymazeCache(log, path)